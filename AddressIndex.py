@@ -0,0 +1,112 @@
+import os
+import math
+import json
+import sqlite3
+import threading
+
+# Geometry checks of the local address index
+try:
+    from shapely import wkb
+    from shapely.geometry import Point
+except ImportError:
+    wkb = None
+    Point = None
+
+
+# Local address index of the regions where most devices are. Buildings, cities, roads and water of the regions are
+# extracted from the OSM tables by build_address_index.py into a SQLite file with an R*Tree of their bounding boxes.
+# Points inside the regions are looked up in-process, the other points are sent to PostGIS.
+
+# Layers of the address in the order of ConnectionOSM.merge_address:
+# (layer, table, columns of the query, keys of the address, condition, distance)
+# distance is the search radius of ST_DWithin in EPSG:3857 units, None means ST_Within
+LAYERS = (
+    ("building", "osm_building_polygon", "postcode, city, street, housenumber",
+     ("postcode", "city", "street", "housenumber"), "street<>''", 100),
+    ("city", "osm_cities", "postcode, country, region, district, type, name",
+     ("postcode", "country", "region", "district", "type", "city"), "name<>''", None),
+    ("road", "osm_highway_linestring", "network, ref, highway, name",
+     ("network", "ref", "highway", "name"), "name<>''", 100),
+    ("water", "osm_water_polygon", "osm_water_polygon.natural, name",
+     ("natural", "name"), "name<>''", None)
+)
+
+# Bounding boxes in the R*Tree are expanded by the distance of the layer, so the candidates of a point are the
+# features whose box contains the point
+SCHEMA = "CREATE TABLE regions (min_lng REAL, min_lat REAL, max_lng REAL, max_lat REAL);" \
+         "CREATE TABLE features (id INTEGER PRIMARY KEY, layer INTEGER, address TEXT, geometry BLOB);" \
+         "CREATE VIRTUAL TABLE features_rtree USING rtree(id, min_x, max_x, min_y, max_y);"
+
+EARTH_RADIUS = 6378137
+
+
+# Coordinates of the point in EPSG:3857, the same as ST_Transform of PostGIS
+def to_mercator(lng, lat):
+    return math.radians(lng) * EARTH_RADIUS, math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * EARTH_RADIUS
+
+
+class AddressIndex:
+    # The file is opened read-only and memory-mapped by every thread which uses it
+    def __init__(self, file):
+        if wkb is None:
+            raise Exception("shapely module is required for the address index")
+        if not os.path.exists(file):
+            raise Exception("file {} doesn't exist".format(file))
+        self._file = file
+        self._mmap_size = os.path.getsize(file)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._regions = self.db().execute("SELECT min_lng, min_lat, max_lng, max_lat FROM regions").fetchall()
+
+    def db(self):
+        if not hasattr(self._local, "db"):
+            db = sqlite3.connect("file:{}?mode=ro".format(self._file), uri=True, check_same_thread=False)
+            db.execute("PRAGMA mmap_size = {}".format(self._mmap_size))
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return self._local.db
+
+    def covers(self, lng, lat):
+        for min_lng, min_lat, max_lng, max_lat in self._regions:
+            if (min_lng <= lng <= max_lng) and (min_lat <= lat <= max_lat):
+                return True
+        return False
+
+    # Returns None if the point is outside the regions of the index,
+    # otherwise [building, city, road, water], each one is the address dict found in the layer or None
+    def lookup(self, lng, lat):
+        if not self.covers(lng, lat):
+            return None
+        x, y = to_mercator(lng, lat)
+        point = Point(x, y)
+        rows = self.db().execute("SELECT f.layer, f.address, f.geometry FROM features_rtree r "
+                                 "JOIN features f ON f.id = r.id "
+                                 "WHERE r.min_x <= ? AND r.max_x >= ? AND r.min_y <= ? AND r.max_y >= ? "
+                                 "ORDER BY f.id", (x, x, y, y)).fetchall()
+        found = [None] * len(LAYERS)
+        distances = [None] * len(LAYERS)
+        for layer, address, geometry in rows:
+            distance = LAYERS[layer][5]
+            if distance is None:
+                if (found[layer] is None) and wkb.loads(geometry).contains(point):
+                    found[layer] = address
+                continue
+            # The nearest feature of the layer within the distance
+            feature_distance = wkb.loads(geometry).distance(point)
+            if (feature_distance <= distance) and ((distances[layer] is None) or
+                                                   (feature_distance < distances[layer])):
+                found[layer] = address
+                distances[layer] = feature_distance
+        return [None if address is None else json.loads(address) for address in found]
+
+    def close(self):
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for db in connections:
+            try:
+                db.close()
+            except Exception:
+                pass
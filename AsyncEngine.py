@@ -0,0 +1,398 @@
+import asyncio
+import json
+import time
+from decimal import Decimal
+
+import aiohttp
+import asyncpg
+import redis.asyncio as aioredis
+
+import Connection as connections
+import Processing as processing
+import Pool as pools
+import Metrics as metrics
+
+
+# Processes many chunks of devices at the same time in one event loop.
+# The number of simultaneous requests to each backend is bounded by its own semaphore.
+# MySQL and Oracle have no asyncio drivers in the project, their calls run in the default executor.
+class AsyncEngine:
+    def __init__(self, config_file, logger, is_first, cache=None, checkpoint=None, updated_devices=None,
+                 failed=None):
+        self._config_file = config_file
+        self._logger = logger
+        self._is_first = is_first
+        if cache is None:
+            cache = {'osm': None, 'tz': None}
+        self._cache = cache
+        self._checkpoint = checkpoint
+        # Sorted list of devices updated since the last run, all devices are processed if it is None
+        self._updated_devices = updated_devices
+        # Processing.FailedDevices of the incremental run
+        self._failed = failed
+        self._config = pools.read_config(config_file)
+        self._movement_threshold = float(self._config["PostgreSQL"].get("movement_threshold", 0))
+        self._min_time_delta = float(self._config["PostgreSQL"].get("min_time_delta", 0))
+        settings = self._config.get("Async") or {}
+        self._limits = dict((name, int(settings.get(name, default)))
+                            for name, default in (("chunks", 32), ("oracle", 4), ("redis", 16), ("psql", 8),
+                                                  ("osm", 16), ("tz", 64)))
+        self._semaphore = {}
+        self._mysql = None
+        self._oracle = None
+        self._redis = None
+        self._psql = None
+        self._osm = None
+        self._index = None
+        self._http = None
+        self._tz = None
+        self._tz_url = "http://{}:{}/tz.json".format(self._config["TimeZoneServer"]["host"],
+                                                     self._config["TimeZoneServer"]["port"])
+        self.errors_cnt = 0
+        self.inserted_rows_cnt = 0
+        self.unchanged_loc_cnt = 0
+        self.max_time = 0
+
+    # Devices whose location hasn't been written because of an error
+    def fail(self, devices):
+        self.errors_cnt += len(devices)
+        if self._failed is not None:
+            self._failed.add(devices)
+
+    # Thread target, messages are the same as the ones of insert_first/last_dev_locations
+    # devices_range = (first_id, last_id], first_id is not included
+    def run(self, que, devices_range):
+        try:
+            asyncio.run(self.process_devices(que, devices_range))
+        except Exception as e:
+            self._logger.critical("Failed to process devices. The error occurred: {}.".format(e))
+            que.put({'error': -11})
+
+    async def process_devices(self, que, devices_range):
+        error = await self.create_connections()
+        if error:
+            await self.close_connections()
+            que.put({'error': error})
+            return
+
+        chunks = asyncio.Semaphore(self._limits['chunks'])
+        tasks = set()
+        # Devices are selected by chunks with keyset pagination
+        devices_chunks = processing.select_devices({'mysql': self._mysql}, devices_range, self._checkpoint,
+                                                   self._updated_devices)
+        try:
+            while 1:
+                await chunks.acquire()
+                error, devices, chunk_range = await asyncio.to_thread(next, devices_chunks, (0, None, None))
+                if error:
+                    que.put({'error': error})
+                    return
+                if devices is None:
+                    chunks.release()
+                    break
+                task = asyncio.create_task(self.process_chunk(que, devices, chunk_range))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: chunks.release())
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.close_connections()
+        self._logger.info("Max processing time of one chunk of devices: {}".format(self.max_time))
+        que.put({'finish': (self.errors_cnt, self.inserted_rows_cnt, self.unchanged_loc_cnt, self.max_time)})
+
+    async def process_chunk(self, que, devices, chunk_range):
+        start_time = time.time()
+        if self._is_first:
+            locations = await self.select_first_locations(devices)
+        else:
+            locations = await self.select_last_locations(devices)
+        rows = await asyncio.gather(*[self.define_timezone(*location) for location in locations])
+        rows = await self.define_addresses([row for row in rows if row is not None])
+        failed = await self.insert_rows(rows)
+        # Rows of the chunk are committed by insert_rows, the chunk with rows which have failed to be written is
+        # processed again by the resumed run
+        if (self._checkpoint is not None) and not failed:
+            self._checkpoint.done(chunk_range[0], chunk_range[1], len(devices))
+        cur_time = time.time() - start_time
+        metrics.observe("chunk", cur_time)
+        if cur_time > self.max_time:
+            self.max_time = cur_time
+        que.put({'progress': len(devices)})
+
+    async def create_connections(self):
+        try:
+            self._semaphore = dict((name, asyncio.Semaphore(limit)) for name, limit in self._limits.items())
+            self._mysql = connections.ConnectionMysql(self._config_file, self._logger)
+            error = self._mysql.create_connection()
+            if error:
+                return error
+            if self._is_first:
+                # Oracle connections are shared by the chunks through the queue
+                self._oracle = asyncio.Queue()
+                for i in range(self._limits['oracle']):
+                    oracle = connections.ConnectionOracle(self._config_file, self._logger)
+                    error = oracle.create_connection()
+                    if error:
+                        return error
+                    self._oracle.put_nowait(oracle)
+            else:
+                self._redis = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+                    host=self._config["Redis"]["host"],
+                    port=self._config["Redis"]["port"],
+                    max_connections=self._limits['redis']
+                ))
+
+            self._tz = connections.ConnectionTimeZoneServer(self._config_file, self._logger, self._cache['tz'])
+            if self._config["TimeZoneServer"].get("offline", False):
+                error = self._tz.create_connection()
+                if error:
+                    return error
+            else:
+                self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._limits['tz']))
+            if self._config["OSM"].get("index_file"):
+                self._index = connections.ConnectionOSM.open_index(self._config["OSM"]["index_file"])
+        except Exception as e:
+            self._logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+            return -10
+
+        for dbms in ("PostgreSQL", "OSM"):
+            try:
+                pool = await asyncpg.create_pool(
+                    host=self._config[dbms]["host"],
+                    port=self._config[dbms]["port"],
+                    user=self._config[dbms]["user"],
+                    password=self._config[dbms]["password"],
+                    database=self._config[dbms]["database"],
+                    min_size=1,
+                    max_size=self._limits['psql' if dbms == "PostgreSQL" else 'osm']
+                )
+            except Exception as e:
+                self._logger.error("Failed to connect to {}. The error occurred: {}.".format(dbms, e))
+                return -10
+            if dbms == "PostgreSQL":
+                self._psql = pool
+            else:
+                self._osm = pool
+        return 0
+
+    async def close_connections(self):
+        for pool in (self._psql, self._osm):
+            if pool is not None:
+                await pool.close()
+        if self._redis is not None:
+            await self._redis.close()
+            await self._redis.connection_pool.disconnect()
+        if self._http is not None:
+            await self._http.close()
+        if self._oracle is not None:
+            while not self._oracle.empty():
+                self._oracle.get_nowait().close_connection()
+        if self._mysql is not None:
+            self._mysql.close_connection()
+
+    # Returns [(device_id, lng, lat, speed, ts), ...]
+    async def select_first_locations(self, devices):
+        oracle = await self._oracle.get()
+        try:
+            async with self._semaphore['oracle']:
+                await asyncio.to_thread(oracle.select_data_bulk, devices)
+            selected_data = oracle.selected_data
+        finally:
+            self._oracle.put_nowait(oracle)
+
+        locations = []
+        for device in devices:
+            if device not in selected_data:
+                self.fail([device])
+                continue
+            location = selected_data[device]
+            if location[3] > time.time():
+                self._logger.error("Device: {}. Incorrect timestamp.".format(device))
+                self.fail([device])
+                continue
+            locations.append((device, location[0], location[1], location[2], location[3]))
+        return locations
+
+    # Returns [(device_id, lng, lat, speed, ts), ...] of devices which have changed their location
+    async def select_last_locations(self, devices):
+        # Select last locations of devices from geo_summary
+        query = connections.ConnectionPostgresql.select_query.format(
+            "$1", latest_table=connections.ConnectionPostgresql.latest_table(self._config["PostgreSQL"]))
+        try:
+            async with self._semaphore['psql']:
+                with metrics.timer("PostgreSQL.select_data"):
+                    rows = await self._psql.fetch(query, devices)
+            last_locations = dict((row[0], tuple(row)) for row in rows)
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to select data from PostgreSQL. "
+                               "The error occurred: {}.".format(devices, e))
+            last_locations = None
+
+        # Select current locations of the whole chunk of devices from Redis
+        try:
+            async with self._semaphore['redis']:
+                with metrics.timer("Redis.select_data_bulk"):
+                    answers = await self._redis.mget(["device:" + str(device) + ":info" for device in devices])
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to select data from Redis. The error occurred: {}.".format(devices,
+                                                                                                              e))
+            self.fail(devices)
+            return []
+
+        locations = []
+        for device, ans in zip(devices, answers):
+            if ans is None:
+                self._logger.error("Device: {}. Failed to select data from Redis.".format(device))
+                self.fail([device])
+                continue
+            try:
+                # [device_id, lng, lat, speed, ts]
+                location = connections.ConnectionRedis.parse_data(device, ans)
+            except Exception as e:
+                self._logger.error("Device: {}. Failed to select data from Redis. "
+                                   "The error occurred: {}.".format(device, e))
+                self.fail([device])
+                continue
+            if location[4] > time.time():
+                self._logger.error("Device: {}. Incorrect timestamp.".format(device))
+                self.fail([device])
+                continue
+
+            # Check if the device's location changed
+            if (last_locations is not None) and (device in last_locations):
+                if processing.is_unchanged(location, last_locations[device], self._movement_threshold,
+                                           self._min_time_delta):
+                    self.unchanged_loc_cnt += 1
+                    continue
+            locations.append(tuple(location))
+        return locations
+
+    # Returns [device_id, lng, lat, address, speed, last_location_time, timezone_shift] or None
+    async def define_timezone(self, device, lng, lat, speed, ts):
+        if self._http is None:
+            # Offline mode, the shift is defined locally
+            if self._tz.select_data(lng, lat, ts):
+                self.fail([device])
+                return None
+            return [device, lng, lat, None, speed, ts, self._tz.selected_data]
+
+        if self._cache['tz'] is not None:
+            shift = self._cache['tz'].get(lng, lat, ts)
+            if shift is not None:
+                return [device, lng, lat, None, speed, ts, shift]
+        data = {"lon": lng, "lat": lat, "t": ts}
+        try:
+            async with self._semaphore['tz']:
+                with metrics.timer("TimeZoneServer.select_data"):
+                    async with self._http.get(self._tz_url, data=data) as response:
+                        json_data = await response.json(content_type=None)
+            if 'failed' in json_data:
+                self._logger.error("Failed to define timezone. Lat: {}, lng: {}, ts_utc: {}.".format(lat, lng, ts))
+                self.fail([device])
+                return None
+            shift = int(json_data['shift']) / 3600
+        except Exception as e:
+            self._logger.error("Failed to define timezone. Lat: {}, lng: {}, ts_utc: {}. "
+                               "The error occurred: {}.".format(lat, lng, ts, e))
+            self.fail([device])
+            return None
+        if self._cache['tz'] is not None:
+            self._cache['tz'].put(lng, lat, ts, shift)
+        return [device, lng, lat, None, speed, ts, shift]
+
+    # Defines addresses of the whole chunk with one query, returns rows with defined addresses
+    async def define_addresses(self, rows):
+        cache = self._cache['osm']
+        if cache is not None:
+            for row in rows:
+                row[3] = cache.get(row[1], row[2])
+        if self._index is not None:
+            for row in rows:
+                if row[3] is None:
+                    row[3] = connections.ConnectionOSM.index_address(self._index, row[1], row[2], self._logger)
+                    if (row[3] is not None) and (cache is not None):
+                        cache.put(row[1], row[2], row[3])
+        missed = [i for i, row in enumerate(rows) if row[3] is None]
+        if missed:
+            query = connections.ConnectionOSM.bulk_query.format("$1", "$2", "$3")
+            try:
+                async with self._semaphore['osm']:
+                    with metrics.timer("OSM.select_data_bulk"):
+                        selected_rows = await self._osm.fetch(query, missed, [float(rows[i][1]) for i in missed],
+                                                              [float(rows[i][2]) for i in missed])
+            except Exception as e:
+                self._logger.error("Points: {}. The error occurred while defining devices' addresses: "
+                                   "{}".format([(rows[i][1], rows[i][2]) for i in missed], e))
+                selected_rows = []
+            layers = []
+            for selected_row in selected_rows:
+                address, layer = connections.ConnectionOSM.parse_bulk_row(tuple(selected_row))
+                layers.append(layer)
+                row = rows[selected_row[0]]
+                if address is None:
+                    self._logger.error("Lng: {}, lat: {}. Failed to define device's address.".format(row[1], row[2]))
+                    continue
+                row[3] = json.dumps(address, sort_keys=True)
+                if cache is not None:
+                    cache.put(row[1], row[2], row[3])
+            connections.ConnectionOSM.count_layers(layers)
+
+        defined_rows = [row for row in rows if row[3] is not None]
+        self.fail([row[0] for row in rows if row[3] is None])
+        return defined_rows
+
+    # Inserts rows into geo_summary and upserts the last locations in one transaction,
+    # falls back to row-by-row inserts on failure
+    # Returns the number of rows which have failed to be written
+    async def insert_rows(self, rows):
+        if not rows:
+            return 0
+        psql = connections.ConnectionPostgresql
+        latest_table = psql.latest_table(self._config["PostgreSQL"])
+        params = ["${}".format(i) for i in range(1, 8)]
+        query = psql.insert_query.format(table=self._config["PostgreSQL"]["table"]) + \
+            psql.row_template.format(*params) + psql.insert_conflict
+        upsert_query = psql.upsert_query.format(latest_table=latest_table) + \
+            psql.latest_row_template.format(*params) + psql.upsert_conflict
+        addresses_query = psql.addresses_query.format("$1", addresses_table=psql.addresses_table(
+            self._config["PostgreSQL"]))
+        address_cache = psql.address_cache(self._config["PostgreSQL"])
+        # asyncpg needs exact types: float for to_timestamp() and Decimal for numeric
+        values = [(row[0], float(row[1]), float(row[2]), row[3], row[4], float(row[5]), Decimal(repr(row[6])))
+                  for row in rows]
+        async with self._semaphore['psql']:
+            async with self._psql.acquire() as connection:
+                addresses = address_cache.missing([row[3] for row in rows])
+                try:
+                    with metrics.timer("PostgreSQL.insert_data"):
+                        async with connection.transaction():
+                            await connection.executemany(query, values)
+                            await connection.executemany(upsert_query, values)
+                            if addresses:
+                                await connection.execute(addresses_query, addresses)
+                    address_cache.put(addresses)
+                    self.inserted_rows_cnt += len(values)
+                    return 0
+                except Exception as e:
+                    self._logger.error("Devices: {}. Failed to insert rows into geo_summary in one batch, they will "
+                                       "be inserted one by one. "
+                                       "The error occurred: {}.".format([row[0] for row in rows], e))
+                failed = 0
+                for value in values:
+                    addresses = address_cache.missing([value[3]])
+                    try:
+                        async with connection.transaction():
+                            await connection.execute(query, *value)
+                            await connection.execute(upsert_query, *value)
+                            if addresses:
+                                await connection.execute(addresses_query, addresses)
+                        address_cache.put(addresses)
+                        self.inserted_rows_cnt += 1
+                    except Exception as e:
+                        self._logger.error("Device: {}. Failed to insert new row into geo_summary. "
+                                           "The error occurred: {}.".format(value[0], e))
+                        self.fail([value[0]])
+                        failed += 1
+                return failed
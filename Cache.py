@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import threading
+import sqlite3
+import bisect
+
+
+class GeocodeCache:
+    # LRU cache of defined addresses shared by all threads
+    # Points are quantized to cells of cell_size degrees (0.0001 degree is ~10 m of latitude)
+    create_table_query = "CREATE TABLE IF NOT EXISTS geocode_cache (lng_cell INTEGER, lat_cell INTEGER, " \
+                         "cell_size REAL, address TEXT, used INTEGER, PRIMARY KEY (lng_cell, lat_cell, cell_size))"
+
+    def __init__(self, size=100000, cell_size=0.0001, file=None):
+        self._size = size
+        self._cell_size = cell_size
+        self._file = file
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lng, lat):
+        return int(round(lng / self._cell_size)), int(round(lat / self._cell_size))
+
+    def get(self, lng, lat):
+        key = self.key(lng, lat)
+        with self._lock:
+            address = self._data.get(key)
+            if address is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return address
+
+    def put(self, lng, lat, address):
+        key = self.key(lng, lat)
+        with self._lock:
+            self._data[key] = address
+            self._data.move_to_end(key)
+            if len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    # Load the cache saved by the previous run, the least recently used addresses go first
+    def load(self):
+        if self._file is None:
+            return 0
+        connection = sqlite3.connect(self._file)
+        try:
+            connection.execute(self.create_table_query)
+            rows = connection.execute("SELECT lng_cell, lat_cell, address FROM geocode_cache WHERE cell_size = ? "
+                                      "ORDER BY used DESC LIMIT ?", (self._cell_size, self._size)).fetchall()
+        finally:
+            connection.close()
+        with self._lock:
+            for lng_cell, lat_cell, address in reversed(rows):
+                self._data[(lng_cell, lat_cell)] = address
+        return len(rows)
+
+    def save(self):
+        if self._file is None:
+            return 0
+        with self._lock:
+            rows = [(key[0], key[1], self._cell_size, address, used)
+                    for used, (key, address) in enumerate(self._data.items())]
+        connection = sqlite3.connect(self._file)
+        try:
+            with connection:
+                connection.execute(self.create_table_query)
+                connection.execute("DELETE FROM geocode_cache")
+                connection.executemany("INSERT INTO geocode_cache VALUES (?, ?, ?, ?, ?)", rows)
+        finally:
+            connection.close()
+        return len(rows)
+
+
+class TimeZoneCache:
+    # LRU cache of timezone shifts shared by all threads
+    # Points are quantized to cells of cell_size degrees. For each cell the cache keeps intervals of time
+    # [start, end, shift] where the shift is known to be constant. Two samples with the same shift are merged into
+    # one interval if they are not more than max_gap seconds apart: a timezone can't change its shift and change it
+    # back within max_gap, so the DST transitions of the cell always stay in the gaps between intervals.
+    def __init__(self, size=100000, cell_size=0.01, max_gap=7 * 86400):
+        self._size = size
+        self._cell_size = cell_size
+        self._max_gap = max_gap
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lng, lat):
+        return int(round(lng / self._cell_size)), int(round(lat / self._cell_size))
+
+    def get(self, lng, lat, ts):
+        key = self.key(lng, lat)
+        with self._lock:
+            intervals = self._data.get(key)
+            if intervals is not None:
+                i = bisect.bisect_right([interval[0] for interval in intervals], ts) - 1
+                if (i >= 0) and (ts <= intervals[i][1]):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return intervals[i][2]
+            self.misses += 1
+            return None
+
+    def put(self, lng, lat, ts, shift):
+        key = self.key(lng, lat)
+        with self._lock:
+            intervals = self._data.setdefault(key, [])
+            self._data.move_to_end(key)
+            if len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+            i = bisect.bisect_right([interval[0] for interval in intervals], ts)
+            left = intervals[i - 1] if i > 0 else None
+            right = intervals[i] if i < len(intervals) else None
+            if (left is not None) and (ts <= left[1]):
+                return
+            if (left is not None) and (left[2] == shift) and (ts - left[1] <= self._max_gap):
+                left[1] = ts
+                if (right is not None) and (right[2] == shift) and (right[0] - ts <= self._max_gap):
+                    left[1] = right[1]
+                    del intervals[i]
+            elif (right is not None) and (right[2] == shift) and (right[0] - ts <= self._max_gap):
+                right[0] = ts
+            else:
+                intervals.insert(i, [ts, ts, shift])
+
+
+class AddressTableCache:
+    # LRU cache of the addresses already written to the addresses table, shared by all threads of the process
+    # Rows reference the addresses by id = md5 of their jsonb text, which is computed by PostgreSQL, so the cache
+    # only has to know that the address is in the table and its upsert can be skipped
+    def __init__(self, size=100000):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the sorted distinct addresses which are not known to be in the table,
+    # transactions upsert them in the same order and don't wait for each other in a cycle
+    def missing(self, addresses):
+        missing = set()
+        with self._lock:
+            for address in addresses:
+                if address in self._data:
+                    self._data.move_to_end(address)
+                    self.hits += 1
+                elif address not in missing:
+                    missing.add(address)
+                    self.misses += 1
+        return sorted(missing)
+
+    # Called after the transaction which has written the addresses is committed
+    def put(self, addresses):
+        if self._size <= 0:
+            return
+        with self._lock:
+            for address in addresses:
+                self._data[address] = True
+                self._data.move_to_end(address)
+            while len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+    # The cache is kept with the connection pools of the process and is cleared by Pool.close_pools
+    def close(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+import bisect
+
+
+class Checkpoint:
+    # Ranges of device ids (first_id, last_id] which have been processed and whose rows have been committed,
+    # they are shared by all threads and saved to a JSON file, so an interrupted run can be resumed.
+    # The ranges of the run with and without the key -f are saved separately.
+    def __init__(self, file, is_first, interval=10):
+        self._file = file
+        self._mode = "first" if is_first else "last"
+        self._interval = interval
+        self._saved_time = 0
+        # [[first_id, last_id, devices_cnt], ...] sorted by first_id, adjacent ranges are merged
+        self._ranges = []
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # Number of devices processed by the interrupted run
+        self.devices_cnt = 0
+
+    # Load the ranges processed by the interrupted run, the ranges of the finished run are not loaded
+    # Returns the number of processed devices
+    def load(self):
+        if not os.path.exists(self._file):
+            return 0
+        with open(self._file, 'r') as stream:
+            data = json.load(stream)
+        if (data.get("mode") != self._mode) or data.get("complete"):
+            return 0
+        with self._lock:
+            self._ranges = []
+            for first_id, last_id, devices_cnt in data.get("ranges", []):
+                self.add_range(first_id, last_id, devices_cnt)
+            self.devices_cnt = sum(r[2] for r in self._ranges)
+        return self.devices_cnt
+
+    # The run is complete, if it has finished without critical errors, then the next run with -r starts from scratch
+    def save(self, complete=False):
+        with self._save_lock:
+            with self._lock:
+                data = {"mode": self._mode, "complete": complete, "ranges": [list(r) for r in self._ranges]}
+                self._saved_time = time.time()
+            # Replace the file at once, so it is never left half-written
+            tmp_file = self._file + ".tmp"
+            with open(tmp_file, 'w') as stream:
+                json.dump(data, stream)
+            os.replace(tmp_file, self._file)
+
+    # Mark the range of devices as processed, the file is saved not more often than once per interval seconds
+    def done(self, first_id, last_id, devices_cnt):
+        if last_id <= first_id:
+            return
+        with self._lock:
+            self.add_range(first_id, last_id, devices_cnt)
+            save = time.time() - self._saved_time >= self._interval
+        if save:
+            try:
+                self.save()
+            except OSError:
+                # The next save will try again, the error of the last save is logged by main
+                pass
+
+    def add_range(self, first_id, last_id, devices_cnt):
+        i = bisect.bisect_left([r[0] for r in self._ranges], first_id)
+        self._ranges.insert(i, [first_id, last_id, devices_cnt])
+        # Merge with the neighbours which touch or overlap the new range
+        while (i + 1 < len(self._ranges)) and (self._ranges[i + 1][0] <= self._ranges[i][1]):
+            right = self._ranges.pop(i + 1)
+            self._ranges[i][1] = max(self._ranges[i][1], right[1])
+            self._ranges[i][2] += right[2]
+        if (i > 0) and (self._ranges[i - 1][1] >= first_id):
+            left = self._ranges[i - 1]
+            left[1] = max(left[1], self._ranges[i][1])
+            left[2] += self._ranges.pop(i)[2]
+
+    # Returns the parts of the range (first_id, last_id] which haven't been processed yet
+    def remaining(self, devices_range):
+        first_id, last_id = devices_range
+        parts = []
+        with self._lock:
+            for done_first, done_last, devices_cnt in self._ranges:
+                if done_first >= last_id:
+                    break
+                if done_last <= first_id:
+                    continue
+                if done_first > first_id:
+                    parts.append((first_id, done_first))
+                first_id = done_last
+        if first_id < last_id:
+            parts.append((first_id, last_id))
+        return parts
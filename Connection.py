@@ -1,18 +1,69 @@
 from abc import ABC, abstractmethod
-import yaml
 import base64
 import json
+import time
 from datetime import datetime
 
 import mysql.connector
 import cx_Oracle
 import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import requests
+import requests.adapters
+
+import Pool as pools
+import Cache as caches
+import Metrics as metrics
+import AddressIndex as address_indexes
 
 # Protobuf structure GPS
 import proto_storage_pb2
 
+# Decoding of Redis data into NumPy arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Offline mode of TimeZoneServer
+try:
+    from timezonefinder import TimezoneFinder
+    from zoneinfo import ZoneInfo
+except ImportError:
+    TimezoneFinder = None
+    ZoneInfo = None
+
+
+# Connection which remembers the statements prepared in its session
+class PreparedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# Pool of PostgreSQL connections in autocommit mode shared by all threads
+def create_postgresql_pool(dbms, host, port, user, password, database, size, connection_factory=None):
+    def connect():
+        connection = psycopg2.connect(host=host, port=port, user=user, password=password, database=database,
+                                      connection_factory=connection_factory)
+        connection.autocommit = True
+        return connection
+
+    return pools.get_pool((dbms, host, port, database), lambda: pools.LazyPool(
+        connect, size, (psycopg2.OperationalError, psycopg2.InterfaceError)))
+
+
+# HTTP session with a pool of size connections, the broken connection is reopened and the request is repeated
+def create_session(size):
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=size, max_retries=1))
+    return session
+
+
 class Connection(ABC):
     dbms = ""
 
@@ -24,10 +75,11 @@ class Connection(ABC):
         self._database = "-"
         self._table = "-"
         self._connection = None
+        self._pool = None
         self.selected_data = None
         self._logger = logger
-        with open(config_file, 'r') as stream:
-            config = yaml.safe_load(stream)
+        config = pools.read_config(config_file)
+        self._config = config[self.dbms]
         self._host = config[self.dbms]["host"]
         self._port = config[self.dbms]["port"]
         if "user" in config[self.dbms]:
@@ -38,11 +90,23 @@ class Connection(ABC):
             self._database = config[self.dbms]["database"]
         if "table" in config[self.dbms]:
             self._table = config[self.dbms]["table"]
+        # Connections shared by all threads
+        self._pool_size = int(self._config.get("pool_size", 16))
 
     @abstractmethod
     def create_connection(self):
         pass
 
+    def check_pool(self):
+        # Connections are opened on first use, so one connection is taken from the pool and returned at once:
+        # an unreachable backend stops the run at startup instead of failing every device
+        try:
+            self._pool.release(self._pool.acquire())
+            return 0
+        except Exception as e:
+            self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
+            return -10
+
     @abstractmethod
     def select_data(self):
         pass
@@ -53,6 +117,9 @@ class Connection(ABC):
 
 
 class ConnectionMysql(Connection):
+    # Shard (index, count) of the devices processed by the process: device_id % count = index - 1, set by main
+    shard = None
+
     def __init__(self, config_file, logger):
         self.dbms = "MySQL"
         super().__init__(config_file, logger)
@@ -64,40 +131,155 @@ class ConnectionMysql(Connection):
             raise Exception("'database'")
         if self._table == "-":
             raise Exception("'table'")
-        self._cursor = None
+        # Number of devices selected at once
+        self.chunk = int(self._config.get("chunk", 1000))
+        # Seconds the server waits for the client to read the streamed devices
+        self.stream_timeout = int(self._config.get("stream_timeout", 3600))
 
     def __del__(self):
         self.close_connection()
 
     def create_connection(self):
+        # The connection is opened on first use
         self.close_connection()
+        settings = dict(host=self._host, port=self._port, user=self._user, passwd=self._password,
+                        database=self._database)
+        self._pool = pools.get_pool((self.dbms, self._host, self._port, self._database), lambda: pools.LazyPool(
+            lambda: mysql.connector.connect(**settings), self._pool_size,
+            (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)))
+        return self.check_pool()
+
+    def execute_query(self, query, parameters=()):
+        # Returns all rows, the query is prepared by the server
+        return self._pool.run(pools.fetch_all, query, parameters, prepared=True)
+
+    def shard_condition(self):
+        # Returns (condition, parameters) of the devices of the shard
+        if self.shard is None:
+            return "", ()
+        return " AND MOD(device_id, %s) = %s", (self.shard[1], self.shard[0] - 1)
+
+    @metrics.timed("select_data")
+    def select_data(self, last_id=None, max_id=None):
+        # Keyset pagination: the next chunk of devices of the range (last_id, max_id]
+        condition, parameters = self.shard_condition()
+        if last_id is not None:
+            query = "SELECT device_id FROM {} WHERE device_id > %s AND device_id <= %s{} " \
+                    "ORDER BY device_id LIMIT %s;".format(self._table, condition)
+        else:
+            query = "SELECT count(device_id) FROM {} WHERE 1 = 1{};".format(self._table, condition)
         try:
-            self._connection = mysql.connector.connect(
-                host=self._host,
-                port=self._port,
-                user=self._user,
-                passwd=self._password,
-                database=self._database
-            )
-            self._cursor = self._connection.cursor(prepared=True)
+            if last_id is not None:
+                rows = self.execute_query(query, (last_id, max_id) + parameters + (self.chunk,))
+                self.selected_data = [row[0] for row in rows]
+            else:
+                self.selected_data = self.execute_query(query, parameters)[0][0]
             return 0
+        except Exception as e:
+            self._logger.error("Failed to select data from {}. The error occurred: {}.".format(self.dbms, e))
+            self.selected_data = None
+            return -11
+
+    @metrics.timed("select_estimate")
+    def select_estimate(self):
+        # Estimated number of devices from the table statistics, the table is not scanned
+        # self.selected_data = rows_number
+        database, table = self._table.split(".", 1) if "." in self._table else (self._database, self._table)
+        query = "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s;"
+        try:
+            rows = self.execute_query(query, (database, table))
+            rows_number = int(rows[0][0] or 0) if rows else 0
+            # Devices of the shard are a part of the table
+            self.selected_data = rows_number // self.shard[1] if self.shard is not None else rows_number
+            return 0
+        except Exception as e:
+            self._logger.error("Failed to select data from {}. The error occurred: {}.".format(self.dbms, e))
+            self.selected_data = None
+            return -11
+
+    def stream_data(self, devices_ranges):
+        # All devices of the ranges [(first_id, last_id], ...] are read by one query per range through an unbuffered
+        # cursor of one connection: the server sends the rows while they are fetched, nothing is counted in advance
+        # and memory doesn't depend on the number of devices
+        # Yields (error, devices, chunk_range) like Processing.select_devices
+        condition, parameters = self.shard_condition()
+        query = "SELECT device_id FROM {} WHERE device_id > %s AND device_id <= %s{} " \
+                "ORDER BY device_id;".format(self._table, condition)
+        try:
+            connection = self._pool.acquire()
         except Exception as e:
             self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
-            return -10
+            yield -10, None, None
+            return
+        # An unfinished stream leaves unread rows on the connection, it is not returned to the pool
+        broken = True
+        try:
+            cursor = connection.cursor(buffered=False)
+            # Workers may keep the stream waiting while the queue of chunks is full
+            cursor.execute("SET SESSION net_write_timeout = %s", (self.stream_timeout,))
+            for first_id, last_id in devices_ranges:
+                cursor.execute(query, (first_id, last_id) + parameters)
+                chunk_first_id = first_id
+                while 1:
+                    with metrics.timer(self.dbms + ".stream_data"):
+                        rows = cursor.fetchmany(self.chunk)
+                    if not rows:
+                        break
+                    devices = [row[0] for row in rows]
+                    # The last chunk covers the rest of the range
+                    chunk_range = (chunk_first_id, devices[-1] if len(rows) == self.chunk else last_id)
+                    yield 0, devices, chunk_range
+                    chunk_first_id = devices[-1]
+            cursor.close()
+            broken = False
+        except Exception as e:
+            self._logger.error("Failed to select data from {}. The error occurred: {}.".format(self.dbms, e))
+            yield -11, None, None
+        finally:
+            self._pool.release(connection, broken)
 
-    def select_data(self, offset=-1, rows_number=10):
-        if offset != -1:
-            query = "SELECT device_id FROM {} ORDER BY device_id LIMIT %s, %s;".format(self._table)
-        else:
-            query = "SELECT count(device_id) FROM {};".format(self._table)
+    @metrics.timed("select_existing")
+    def select_existing(self, device_ids):
+        # Keep the devices of the list which are present in MySQL
+        # self.selected_data = [device_id, ...] sorted by device_id
+        query = "SELECT device_id FROM {} WHERE device_id IN ({}) " \
+                "ORDER BY device_id;".format(self._table, ", ".join(["%s"] * len(device_ids)))
         try:
-            if offset != -1:
-                self._cursor.execute(query, (offset, rows_number))
-                rows = self._cursor.fetchall()
-                self.selected_data = [row[0] for row in rows]
-            else:
-                self._cursor.execute(query)
-                self.selected_data = self._cursor.fetchall()[0][0]
+            self.selected_data = [row[0] for row in self.execute_query(query, tuple(device_ids))]
+            return 0
+        except Exception as e:
+            self._logger.error("Failed to select data from {}. The error occurred: {}.".format(self.dbms, e))
+            self.selected_data = None
+            return -11
+
+    @metrics.timed("select_boundaries")
+    def select_boundaries(self, parts):
+        # Split devices into parts with the same number of devices
+        # self.selected_data = (rows_number, [boundary_0, ..., boundary_parts]), part i is (boundary_i, boundary_i+1]
+        condition, parameters = self.shard_condition()
+        try:
+            query = "SELECT count(device_id), min(device_id), max(device_id) FROM {} " \
+                    "WHERE 1 = 1{};".format(self._table, condition)
+            rows_number, min_id, max_id = self.execute_query(query, parameters)[0]
+            if not rows_number:
+                self.selected_data = (0, [0] * (parts + 1))
+                return 0
+            # Every boundary is found from the previous one, so the index is read once for all boundaries
+            boundaries = [min_id - 1]
+            rank = -1
+            query = "SELECT device_id FROM {} WHERE device_id > %s{} ORDER BY device_id " \
+                    "LIMIT %s, 1;".format(self._table, condition)
+            for i in range(1, parts):
+                next_rank = max(i * rows_number // parts - 1, 0)
+                rows = self.execute_query(query, (boundaries[-1],) + parameters + (next_rank - rank - 1,)) \
+                    if next_rank > rank else None
+                if rows:
+                    rank = next_rank
+                    boundaries.append(rows[0][0])
+                else:
+                    boundaries.append(boundaries[-1])
+            boundaries.append(max(max_id, boundaries[-1]))
+            self.selected_data = (rows_number, boundaries)
             return 0
         except Exception as e:
             self._logger.error("Failed to select data from {}. The error occurred: {}.".format(self.dbms, e))
@@ -105,12 +287,23 @@ class ConnectionMysql(Connection):
             return -11
 
     def close_connection(self):
-        if (self._connection is not None) and self._connection.is_connected():
-            self._connection.close()
+        # Connections are returned to the pool after each query
         self.selected_data = None
 
 
 class ConnectionOracle(Connection):
+    # Sessions keep the prepared statements in their statement caches
+    time_query = "SELECT time FROM {table} WHERE device=:dev OFFSET 0 ROWS FETCH NEXT 1 ROWS ONLY"
+    min_time_query = "SELECT min(time) time FROM {table} WHERE device=:dev"
+    location_query = "SELECT lng, lat, speed FROM {table} WHERE device=:dev AND " \
+                     "time=TO_TIMESTAMP(:tm, 'DD-MM-YYYY HH24.MI.SS.FF') AND ROWNUM < 2"
+    # First location of each device of the chunk, device ids are bound as an array
+    bulk_query = "SELECT device, lng, lat, speed, time FROM (" \
+                 "SELECT device, lng, lat, speed, time, " \
+                 "ROW_NUMBER() OVER (PARTITION BY device ORDER BY time) rn FROM {table} " \
+                 "WHERE device IN (SELECT column_value FROM TABLE(:devs)) AND time IS NOT NULL) " \
+                 "WHERE rn = 1"
+
     def __init__(self, config_file, logger):
         self.dbms = "Oracle"
         super().__init__(config_file, logger)
@@ -122,60 +315,29 @@ class ConnectionOracle(Connection):
             raise Exception("'database'")
         if self._table == "-":
             raise Exception("'table'")
-        self._cursor = None
-        self._cursor1 = None
-        self._cursor2 = None
+        self._arraysize = int(self._config.get("arraysize", 1000))
+        self.failed_devices = {}
 
     def __del__(self):
         self.close_connection()
 
     def create_connection(self):
+        # Sessions are opened on first use
         self.close_connection()
-        try:
-            dsn_tns = cx_Oracle.makedsn(
-                self._host,
-                self._port,
-                service_name=self._database
-            )
-            self._connection = cx_Oracle.connect(
-                user=self._user,
-                password=self._password,
-                dsn=dsn_tns
-            )
-
-            self._cursor = self._connection.cursor()
-            query = "SELECT time FROM {} WHERE device=:dev OFFSET 0 ROWS FETCH NEXT 1 ROWS ONLY".format(self._table)
-            self._cursor.prepare(query)
-            self._cursor1 = self._connection.cursor()
-            query = "SELECT min(time) time FROM {} WHERE device=:dev".format(self._table)
-            self._cursor1.prepare(query)
-            self._cursor2 = self._connection.cursor()
-            query = "SELECT lng, lat, speed FROM {} WHERE device=:dev AND " \
-                    "time=TO_TIMESTAMP(:tm, 'DD-MM-YYYY HH24.MI.SS.FF') AND ROWNUM < 2".format(self._table)
-            self._cursor2.prepare(query)
-            return 0
-        except Exception as e:
-            self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
-            return -10
+        settings = dict(user=self._user, password=self._password,
+                        dsn=cx_Oracle.makedsn(self._host, self._port, service_name=self._database),
+                        min=0, max=self._pool_size, increment=1, threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT)
+        self._pool = pools.get_pool((self.dbms, self._host, self._port, self._database), lambda: pools.SessionPool(
+            lambda: cx_Oracle.SessionPool(**settings), (cx_Oracle.OperationalError, cx_Oracle.InterfaceError)))
+        return self.check_pool()
 
+    @metrics.timed("select_data")
     def select_data(self, device):
         try:
-            self._cursor.execute(None, dev=device)
-            dev_time = self._cursor.fetchall()
-            if len(dev_time) == 0:
-                self._logger.error("Device: {}. Failed to select data from {}.".format(device, self.dbms))
-                return -11
-            self._cursor1.execute(None, dev=device)
-            dev_time = self._cursor1.fetchall()[0][0]
-            if dev_time is None:
+            self.selected_data = self._pool.run(self.query_first_location, device)
+            if self.selected_data is None:
                 self._logger.error("Device: {}. Failed to select data from {}.".format(device, self.dbms))
                 return -11
-            self._cursor2.execute(None, dev=device, tm=dev_time.strftime('%d-%m-%Y %H.%M.%S.%f'))
-            dev_data = self._cursor2.fetchall()[0]
-            if dev_data[2] is None:
-                self.selected_data = (dev_data[0], dev_data[1], 0, datetime.timestamp(dev_time))
-            else:
-                self.selected_data = (dev_data[0], dev_data[1], dev_data[2], datetime.timestamp(dev_time))
             return 0
         except Exception as e:
             self._logger.error("Device: {}. Failed to select data from {}. The error occurred: {}.".format(device,
@@ -184,16 +346,97 @@ class ConnectionOracle(Connection):
             self.selected_data = None
             return -11
 
+    def query_first_location(self, connection, device):
+        # Returns (lng, lat, speed, time) or None
+        cursor = connection.cursor()
+        try:
+            cursor.execute(self.time_query.format(table=self._table), dev=device)
+            if len(cursor.fetchall()) == 0:
+                return None
+            cursor.execute(self.min_time_query.format(table=self._table), dev=device)
+            dev_time = cursor.fetchall()[0][0]
+            if dev_time is None:
+                return None
+            cursor.execute(self.location_query.format(table=self._table), dev=device,
+                           tm=dev_time.strftime('%d-%m-%Y %H.%M.%S.%f'))
+            dev_data = cursor.fetchall()[0]
+        finally:
+            cursor.close()
+        if dev_data[2] is None:
+            return dev_data[0], dev_data[1], 0, datetime.timestamp(dev_time)
+        return dev_data[0], dev_data[1], dev_data[2], datetime.timestamp(dev_time)
+
+    @metrics.timed("select_data_bulk")
+    def select_data_bulk(self, device_ids):
+        # Select data of the first location for the whole chunk of devices with one query
+        # self.selected_data = {device_id: (lng, lat, speed, time)}
+        # self.failed_devices = {device_id: error}
+        self.selected_data = {}
+        self.failed_devices = {}
+        try:
+            for device, lng, lat, speed, dev_time in self._pool.run(self.query_first_locations, device_ids):
+                if speed is None:
+                    speed = 0
+                self.selected_data[device] = (lng, lat, speed, datetime.timestamp(dev_time))
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to select data from {}. The error occurred: {}.".format(device_ids,
+                                                                                                            self.dbms,
+                                                                                                            e))
+            self.selected_data = {}
+            self.failed_devices = dict((device_id, -11) for device_id in device_ids)
+            return -11
+
+        for device_id in device_ids:
+            if device_id not in self.selected_data:
+                self._logger.error("Device: {}. Failed to select data from {}.".format(device_id, self.dbms))
+                self.failed_devices[device_id] = -11
+        return 0
+
+    def query_first_locations(self, connection, device_ids):
+        # Returns [(device, lng, lat, speed, time), ...]
+        cursor = connection.cursor()
+        try:
+            cursor.arraysize = self._arraysize
+            cursor.prefetchrows = self._arraysize
+            devices = connection.gettype("SYS.ODCINUMBERLIST").newobject(device_ids)
+            cursor.execute(self.bulk_query.format(table=self._table), devs=devices)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
     def close_connection(self):
+        # Sessions are returned to the pool after each query
         self.selected_data = None
-        try:
-            if self._connection.ping() is None:
-                self._connection.close()
-        except Exception:
-            return
 
 
 class ConnectionPostgresql(Connection):
+    # Queries are shared with AsyncEngine, parameters are formatted in the driver's placeholder style
+    # Last location of each device of the chunk, {latest_table} keeps one row per device
+    select_query = "SELECT device_id, ST_X(last_location) lng, ST_Y(last_location) lat, " \
+                   "cast(extract(epoch FROM last_location_time) as bigint) last_location_time " \
+                   "FROM {latest_table} WHERE device_id = ANY({0});"
+    # Addresses are stored once in {addresses_table}, rows reference them by id = md5 of the jsonb text
+    # {0} is the array of address texts
+    addresses_query = "INSERT INTO {addresses_table} (id, address) SELECT md5(a::jsonb::text)::uuid, a::jsonb " \
+                      "FROM unnest({0}::text[]) a ON CONFLICT (id) DO NOTHING"
+    # values = [device_id, lng, lat, address, speed, last_location_time, timezone_shift]
+    insert_query = "INSERT INTO {table} (uid, device_id, last_location, address_id, speed, last_location_time, " \
+                   "check_time, timezone_shift) VALUES"
+    row_template = "(DEFAULT, {0}, ST_SetSRID(ST_MakePoint({1}, {2}),4326), md5({3}::jsonb::text)::uuid, {4}, " \
+                   "to_timestamp({5}) AT TIME ZONE 'UTC', DEFAULT, {6})"
+    # Rows are unique by (device_id, last_location_time), so a replayed chunk doesn't create duplicates
+    insert_conflict = " ON CONFLICT DO NOTHING"
+    # The row of {latest_table} is replaced only by a location which is not older than the stored one
+    upsert_query = "INSERT INTO {latest_table} AS latest (device_id, last_location, address_id, speed, " \
+                   "last_location_time, check_time, timezone_shift) VALUES"
+    latest_row_template = "({0}, ST_SetSRID(ST_MakePoint({1}, {2}),4326), md5({3}::jsonb::text)::uuid, {4}, " \
+                          "to_timestamp({5}) AT TIME ZONE 'UTC', DEFAULT, {6})"
+    upsert_conflict = " ON CONFLICT (device_id) DO UPDATE SET last_location = EXCLUDED.last_location, " \
+                      "address_id = EXCLUDED.address_id, speed = EXCLUDED.speed, " \
+                      "last_location_time = EXCLUDED.last_location_time, check_time = EXCLUDED.check_time, " \
+                      "timezone_shift = EXCLUDED.timezone_shift " \
+                      "WHERE latest.last_location_time <= EXCLUDED.last_location_time"
+
     def __init__(self, config_file, logger):
         self.dbms = "PostgreSQL"
         super().__init__(config_file, logger)
@@ -205,37 +448,64 @@ class ConnectionPostgresql(Connection):
             raise Exception("'database'")
         if self._table == "-":
             raise Exception("'table'")
+        self._latest_table = self.latest_table(self._config)
+        self._addresses_table = self.addresses_table(self._config)
+        self._address_cache = self.address_cache(self._config)
+        self.batch_size = int(self._config.get("batch_size", 1000))
+        # Locations closer than movement_threshold meters to the last one or newer than it by less than
+        # min_time_delta seconds are not written
+        self.movement_threshold = float(self._config.get("movement_threshold", 0))
+        self.min_time_delta = float(self._config.get("min_time_delta", 0))
+        self._rows = []
+        # Devices whose rows flush_data has failed to write since the last check of Processing.PendingRanges
+        self.failed_devices = []
+
+    @staticmethod
+    def latest_table(config):
+        # Table with the last location of each device, {table}_latest by default
+        return config.get("latest_table", config["table"] + "_latest")
+
+    @staticmethod
+    def addresses_table(config):
+        # Table of the distinct addresses, {table}_addresses by default
+        return config.get("addresses_table", config["table"] + "_addresses")
+
+    @classmethod
+    def address_cache(cls, config):
+        # Addresses known to be in the addresses table, shared by all threads of the process
+        size = int(config.get("address_cache_size", 100000))
+        return pools.get_pool(("AddressTableCache", cls.addresses_table(config)),
+                              lambda: caches.AddressTableCache(size))
+
+    def address_statements(self, addresses):
+        # Upsert of the addresses which are not known to be in the addresses table, rows don't have a foreign key
+        # to the addresses, so it is executed after them in the same transaction
+        # Returns ([(query, values, template)], written addresses)
+        missing = self._address_cache.missing(addresses)
+        if not missing:
+            return [], missing
+        query = self.addresses_query.format("%s", addresses_table=self._addresses_table)
+        return [(query, (missing,), None)], missing
 
     def __del__(self):
         self.close_connection()
 
     def create_connection(self):
+        # The connection is opened on first use
         self.close_connection()
-        try:
-            self._connection = psycopg2.connect(
-                host=self._host,
-                port=self._port,
-                user=self._user,
-                password=self._password,
-                database=self._database
-            )
-            self._connection.autocommit = True
-            return 0
-        except Exception as e:
-            self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
-            return -10
+        self._pool = create_postgresql_pool(self.dbms, self._host, self._port, self._user, self._password,
+                                            self._database, self._pool_size)
+        return self.check_pool()
 
+    @metrics.timed("select_data")
     def select_data(self, device_ids):
-        query = "SELECT DISTINCT ON (device_id) device_id, ST_X(last_location) lng, ST_Y(last_location) lat, " \
-                "cast(extract(epoch FROM last_location_time) as bigint) last_location_time " \
-                "FROM {} WHERE device_id IN ({}) " \
-                "ORDER BY device_id, check_time DESC;".format(self._table, ",".join(map(str, device_ids)))
+        if not device_ids:
+            self.selected_data = {}
+            return 0
+        query = self.select_query.format("%s", latest_table=self._latest_table)
         try:
-            cursor = self._connection.cursor()
-            cursor.execute(query)
-            rows = cursor.fetchall()
+            rows = self._pool.run(pools.fetch_all, query, (list(device_ids),))
             self.selected_data = dict((row[0], row) for row in rows)
-            cursor.close()
             return 0
         except Exception as e:
             self._logger.error("Devices: {}. Failed to select data from {}. The error occurred: {}.".format(device_ids,
@@ -244,28 +514,163 @@ class ConnectionPostgresql(Connection):
             self.selected_data = None
             return -11
 
+    @metrics.timed("insert_data")
     def insert_data(self, values):
         # values = [device_id, lng, lat, address, speed, last_location_time, timezone_shift]
-        query = "INSERT INTO {} VALUES(DEFAULT, %s, ST_SetSRID(ST_MakePoint(%s, %s),4326), %s, %s, " \
-                "to_timestamp(%s) AT TIME ZONE 'UTC', DEFAULT, %s)".format(self._table)
+        # The history row and the last location of the device are written in one transaction
+        query = self.insert_query.format(table=self._table) + self.row_template.format(*["%s"] * 7) + \
+            self.insert_conflict
+        upsert_query = self.upsert_query.format(latest_table=self._latest_table) + \
+            self.latest_row_template.format(*["%s"] * 7) + self.upsert_conflict
+        statements, addresses = self.address_statements([values[3]])
         try:
-            cursor = self._connection.cursor()
-            cursor.execute(query, values)
-            cursor.close()
+            self._pool.run(self.execute_transaction, [(query, values, None), (upsert_query, values, None)] + statements)
+            self._address_cache.put(addresses)
             return 0
         except Exception as e:
             self._logger.error("Device: {}. Failed to insert new row into geo_summary. "
                                "The error occurred: {}.".format(values[0], e))
             return -11
 
+    def add_row(self, values):
+        # Buffer a new row for geo_summary, the buffer is flushed by flush_data
+        # values = [device_id, lng, lat, address, speed, last_location_time, timezone_shift]
+        self._rows.append(values)
+
+    def buffered_rows(self):
+        return len(self._rows)
+
+    @metrics.timed("flush_data")
+    def flush_data(self):
+        # Insert all buffered rows with one multi-row INSERT and upsert the last locations in a single transaction
+        # Returns (inserted_rows_cnt, errors_cnt), the devices of the rows which are not written are added to
+        # failed_devices
+        rows = self._rows
+        self._rows = []
+        if not rows:
+            return 0, 0
+        query = self.insert_query.format(table=self._table) + " %s" + self.insert_conflict
+        template = self.row_template.format(*["%s"] * 7)
+        upsert_query = self.upsert_query.format(latest_table=self._latest_table) + " %s" + self.upsert_conflict
+        upsert_template = self.latest_row_template.format(*["%s"] * 7)
+        # One statement can't update the same row twice, only the newest location of each device is upserted
+        latest_rows = list(dict((row[0], row) for row in sorted(rows, key=lambda row: row[5])).values())
+        statements, addresses = self.address_statements([row[3] for row in rows])
+        try:
+            # Rows which have been inserted by the interrupted run are skipped
+            inserted_rows_cnt = self._pool.run(self.execute_transaction,
+                                               [(query, rows, template), (upsert_query, latest_rows, upsert_template)] +
+                                               statements)
+            self._address_cache.put(addresses)
+            return inserted_rows_cnt, 0
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to insert rows into geo_summary in one batch, they will be "
+                               "inserted one by one. The error occurred: {}.".format([row[0] for row in rows], e))
+
+        # Fall back to row-by-row inserts, so one bad row does not lose the whole batch
+        inserted_rows_cnt = 0
+        for values in rows:
+            if not self.insert_data(values):
+                inserted_rows_cnt += 1
+            else:
+                self.failed_devices.append(values[0])
+        return inserted_rows_cnt, len(rows) - inserted_rows_cnt
+
+    @staticmethod
+    def execute_transaction(connection, statements):
+        # Execute statements [(query, values, template), ...] in one transaction, the statement with a template
+        # inserts all rows of values with one multi-row INSERT
+        # Returns the number of rows of the first statement
+        rows_cnt = []
+        connection.autocommit = False
+        try:
+            with connection:
+                with connection.cursor() as cursor:
+                    for query, values, template in statements:
+                        if template is None:
+                            cursor.execute(query, values)
+                        else:
+                            psycopg2.extras.execute_values(cursor, query, values, template=template,
+                                                           page_size=len(values))
+                        rows_cnt.append(cursor.rowcount)
+        finally:
+            if not connection.closed:
+                connection.autocommit = True
+        return rows_cnt[0]
+
     def close_connection(self):
-        if (self._connection is not None) and (not self._connection.closed):
-            self._connection.close()
+        # Connections are returned to the pool after each query
         self.selected_data = None
 
 
 class ConnectionOSM(Connection):
-    def __init__(self, config_file, logger):
+    # Prepared statements of the layers of select_data: ((types of parameters), statement)
+    # They define the address of a single point, the engines define addresses of chunks with bulk_query
+    # $1, $2 are the coordinates of the point in EPSG:3857, $3 is its latitude
+    layer_statements = {
+        "building": (("float8", "float8", "float8"),
+                     "SELECT postcode, city, street, housenumber FROM osm_building_polygon "
+                     "WHERE ST_DWithin(ST_SetSRID(ST_MakePoint($1, $2), 3857), geometry, 100) AND street<>'' "
+                     "LIMIT 1"),
+        "city": (("float8", "float8", "float8"),
+                 "SELECT postcode, country, region, district, type, name as city FROM osm_cities "
+                 "WHERE ST_Within(ST_SetSRID(ST_MakePoint($1, $2), 3857), geometry) AND name<>'' LIMIT 1"),
+        "road": (("float8", "float8", "float8"),
+                 "SELECT network, ref, highway, name FROM osm_highway_linestring "
+                 "WHERE ST_DWithin(ST_SetSRID(ST_MakePoint($1, $2), 3857), geometry, 100) AND name<>'' LIMIT 1"),
+        "water": (("float8", "float8", "float8"),
+                  "SELECT osm_water_polygon.natural, name FROM osm_water_polygon "
+                  "WHERE ST_Within(ST_SetSRID(ST_MakePoint($1, $2), 3857), geometry) AND name<>'' LIMIT 1"),
+        # The nearest cities are found by the KNN search of the GiST index, then they are ordered by the exact
+        # distance, so the result is the same as the one of ORDER BY ST_Distance over the whole table
+        "nearest": (("float8", "float8", "float8"),
+                    "SELECT country, type, nearest_city FROM (SELECT country, type, name as nearest_city, geometry "
+                    "FROM osm_cities WHERE name<>'' ORDER BY geometry <-> ST_SetSRID(ST_MakePoint($1, $2), 3857) "
+                    "LIMIT 10) AS candidates "
+                    "ORDER BY ST_Distance(ST_SetSRID(ST_MakePoint($1, $2), 3857), geometry) * COSD($3) LIMIT 1")
+    }
+
+    # Names of the layers of bulk_layers
+    layer_names = ("building", "city", "road", "water", "nearest")
+
+    # Columns of each layer of the bulk query and the column which is not NULL if the layer is found
+    bulk_layers = (
+        (('postcode', 'city', 'street', 'housenumber'), 'street'),
+        (('postcode', 'country', 'region', 'district', 'type', 'city'), 'city'),
+        (('network', 'ref', 'highway', 'name'), 'name'),
+        (('natural', 'name'), 'name'),
+        (('country', 'type', 'nearest_city'), 'nearest_city')
+    )
+
+    # Every layer is queried only if the previous layers have not defined the address
+    # The query is shared with AsyncEngine, parameters are formatted in the driver's placeholder style
+    bulk_query = "SELECT p.idx, " \
+                 "b.postcode, b.city, b.street, b.housenumber, " \
+                 "c.postcode, c.country, c.region, c.district, c.type, c.city, " \
+                 "r.network, r.ref, r.highway, r.name, " \
+                 "w.water_natural, w.name, " \
+                 "n.country, n.type, n.nearest_city " \
+                 "FROM unnest({0}::int[], {1}::float8[], {2}::float8[]) AS p(idx, lng, lat) " \
+                 "CROSS JOIN LATERAL (SELECT ST_Transform(ST_SetSRID(ST_MakePoint(p.lng, p.lat), 4326), 3857) " \
+                 "AS geom) AS g " \
+                 "LEFT JOIN LATERAL (SELECT postcode, city, street, housenumber FROM osm_building_polygon " \
+                 "WHERE ST_DWithin(g.geom, geometry, 100) AND street<>'' LIMIT 1) AS b ON true " \
+                 "LEFT JOIN LATERAL (SELECT postcode, country, region, district, type, name as city FROM osm_cities " \
+                 "WHERE coalesce(b.city, '') = '' AND ST_Within(g.geom, geometry) " \
+                 "AND name<>'' LIMIT 1) AS c ON true " \
+                 "LEFT JOIN LATERAL (SELECT network, ref, highway, name FROM osm_highway_linestring " \
+                 "WHERE b.street IS NULL AND ST_DWithin(g.geom, geometry, 100) " \
+                 "AND name<>'' LIMIT 1) AS r ON true " \
+                 "LEFT JOIN LATERAL (SELECT osm_water_polygon.natural AS water_natural, name FROM osm_water_polygon " \
+                 "WHERE b.street IS NULL AND r.name IS NULL AND ST_Within(g.geom, geometry) " \
+                 "AND name<>'' LIMIT 1) AS w ON true " \
+                 "LEFT JOIN LATERAL (SELECT country, type, nearest_city FROM (" \
+                 "SELECT country, type, name as nearest_city, geometry FROM osm_cities " \
+                 "WHERE b.street IS NULL AND c.city IS NULL AND r.name IS NULL AND w.name IS NULL AND name<>'' " \
+                 "ORDER BY geometry <-> g.geom LIMIT 10) AS candidates " \
+                 "ORDER BY ST_Distance(g.geom, geometry) * COSD(p.lat) LIMIT 1) AS n ON true;"
+
+    def __init__(self, config_file, logger, cache=None):
         self.dbms = "OSM"
         super().__init__(config_file, logger)
         if self._user == "-":
@@ -274,33 +679,72 @@ class ConnectionOSM(Connection):
             raise Exception("'password'")
         if self._database == "-":
             raise Exception("'database'")
+        # Cache.GeocodeCache shared by all threads
+        self._cache = cache
+        # Local address index of the regions built by build_address_index.py
+        self._index_file = self._config.get("index_file")
+        self._index = None
 
     def __del__(self):
         self.close_connection()
 
     def create_connection(self):
+        # The connection is opened on first use
         self.close_connection()
+        if self._index_file:
+            try:
+                self._index = self.open_index(self._index_file)
+            except Exception as e:
+                self._logger.error("Failed to open address index. The error occurred: {}.".format(e))
+                return -10
+        self._pool = create_postgresql_pool(self.dbms, self._host, self._port, self._user, self._password,
+                                            self._database, self._pool_size, PreparedConnection)
+        return self.check_pool()
+
+    @staticmethod
+    def open_index(file):
+        # The index is shared by all threads of the process
+        return pools.get_pool(("AddressIndex", file), lambda: address_indexes.AddressIndex(file))
+
+    @classmethod
+    def index_address(cls, index, lng, lat, logger):
+        # Address of the point defined by the local index, None if the point is not covered by the index or
+        # no layer of the index contains it, PostGIS is queried then
         try:
-            self._connection = psycopg2.connect(
-                host=self._host,
-                port=self._port,
-                user=self._user,
-                password=self._password,
-                database=self._database
-            )
-            self._connection.autocommit = True
-            return 0
+            with metrics.timer("OSM.index"):
+                layers = index.lookup(lng, lat)
         except Exception as e:
-            self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
-            return -10
+            logger.error("Lng: {}, lat: {}. Failed to look up the address index. "
+                         "The error occurred: {}.".format(lng, lat, e))
+            return None
+        if layers is None:
+            return None
+        address = cls.merge_address(*layers, None)
+        return None if address is None else json.dumps(address, sort_keys=True)
 
+    @metrics.timed("select_data")
     def select_data(self, lng, lat):
-        # Buildings
-        query = "SELECT postcode, city, street, housenumber FROM osm_building_polygon " \
-                "WHERE ST_DWithin(ST_Transform(ST_GeomFromEWKT('SRID=4326;POINT({} {})'), 3857), " \
-                "geometry, 100) AND street<>'' LIMIT 1;".format(lng, lat)
+        if self._cache is not None:
+            address = self._cache.get(lng, lat)
+            if address is not None:
+                self.selected_data = address
+                return 0
+        address = None if self._index is None else self.index_address(self._index, lng, lat, self._logger)
+        if address is not None:
+            self.selected_data = address
+            error = 0
+        else:
+            error = self.define_address(lng, lat)
+        if (not error) and (self._cache is not None):
+            self._cache.put(lng, lat, self.selected_data)
+        return error
+
+    def define_address(self, lng, lat):
+        # The point is transformed to EPSG:3857 once and bound to the prepared statement of every layer
+        point = address_indexes.to_mercator(lng, lat) + (lat,)
 
-        error = self.execute_query(query)
+        # Buildings
+        error = self.execute_layer_query("building", point)
         if (not error) and (self.selected_data['city']):
             self.selected_data = json.dumps(self.selected_data, sort_keys=True)
             return 0
@@ -309,11 +753,7 @@ class ConnectionOSM(Connection):
             address = self.selected_data
 
         # Cities
-        query = "SELECT postcode, country, region, district, type, name as city FROM osm_cities " \
-                "WHERE ST_Within(ST_Transform(ST_GeomFromEWKT('SRID=4326;POINT({} {})'), 3857), geometry) " \
-                "AND name<>'' LIMIT 1;".format(lng, lat)
-
-        error = self.execute_query(query)
+        error = self.execute_layer_query("city", point)
         if (not error) and not (address is None):
             address['city'] = self.selected_data['city']
             if not address['postcode']:
@@ -327,20 +767,14 @@ class ConnectionOSM(Connection):
             address = self.selected_data
 
         # Roads
-        query = "SELECT network, ref, highway, name FROM osm_highway_linestring " \
-                "WHERE ST_DWithin(ST_Transform(ST_GeomFromEWKT('SRID=4326;POINT({} {})'), 3857), geometry, 100) " \
-                "AND name<>'' LIMIT 1;".format(lng, lat)
-        if not self.execute_query(query):
+        if not self.execute_layer_query("road", point):
             if not (address is None):
                 self.selected_data['city'] = address['city']
             self.selected_data = json.dumps(self.selected_data, sort_keys=True)
             return 0
 
         # Water
-        query = "SELECT osm_water_polygon.natural, name FROM osm_water_polygon " \
-                "WHERE ST_Within(ST_Transform(ST_GeomFromEWKT('SRID=4326;POINT({} {})'), 3857), geometry) " \
-                "AND name<>'' LIMIT 1;".format(lng, lat)
-        if not self.execute_query(query):
+        if not self.execute_layer_query("water", point):
             if not (address is None):
                 self.selected_data['city'] = address['city']
             self.selected_data = json.dumps(self.selected_data, sort_keys=True)
@@ -351,61 +785,186 @@ class ConnectionOSM(Connection):
             return 0
 
         # Nearest city
-        query = "SELECT country, type, name as nearest_city FROM osm_cities WHERE name<>'' " \
-                "ORDER BY ST_Distance(ST_Transform(ST_GeomFromEWKT('SRID=4326;POINT({} {})'), 3857), geometry) " \
-                "* COSD({}) LIMIT 1;".format(lng, lat, lat)
-
-        if not self.execute_query(query):
+        if not self.execute_layer_query("nearest", point):
             self.selected_data = json.dumps(self.selected_data, sort_keys=True)
             return 0
         else:
             self._logger.error("Lng: {}, lat: {}. Failed to define device's address.".format(lng, lat))
             return -11
 
+    @metrics.timed("select_data_bulk")
+    def select_data_bulk(self, points):
+        # Define addresses of the whole chunk of points with one query
+        # points = [(lng, lat), ...]
+        # self.selected_data = [address or None for each point]
+        addresses = [None] * len(points)
+        self.selected_data = addresses
+        # Only the points which are not in the cache are sent to the database
+        if self._cache is not None:
+            for i, point in enumerate(points):
+                addresses[i] = self._cache.get(point[0], point[1])
+        # Then the points of the regions of the local index
+        if self._index is not None:
+            for i, point in enumerate(points):
+                if addresses[i] is None:
+                    addresses[i] = self.index_address(self._index, point[0], point[1], self._logger)
+                    if (addresses[i] is not None) and (self._cache is not None):
+                        self._cache.put(point[0], point[1], addresses[i])
+        missed = [i for i, address in enumerate(addresses) if address is None]
+        if not missed:
+            return 0
+        try:
+            statement = (("int[]", "float8[]", "float8[]"), self.bulk_query.format("$1", "$2", "$3"))
+            columns, rows = self._pool.run(self.fetch_prepared, "osm_bulk", statement,
+                                           (missed, [points[i][0] for i in missed], [points[i][1] for i in missed]))
+        except Exception as e:
+            self._logger.error("Points: {}. The error occurred while defining devices' addresses: "
+                               "{}".format([points[i] for i in missed], e))
+            return -11
+
+        layers = []
+        for row in rows:
+            address, layer = self.parse_bulk_row(row)
+            layers.append(layer)
+            if address is None:
+                self._logger.error("Lng: {}, lat: {}. Failed to define device's address.".format(*points[row[0]]))
+                continue
+            addresses[row[0]] = json.dumps(address, sort_keys=True)
+            if self._cache is not None:
+                self._cache.put(points[row[0]][0], points[row[0]][1], addresses[row[0]])
+        self.count_layers(layers)
+        return 0
+
+    @classmethod
+    def parse_bulk_row(cls, row):
+        # row = (index, columns of each layer of bulk_layers)
+        # Each layer is found if its non-empty name column is not NULL
+        # Returns (address or None, name of the layer which has defined the address or None)
+        layers = []
+        position = 1
+        for columns, name in cls.bulk_layers:
+            layer = dict(zip(columns, row[position:position + len(columns)]))
+            layers.append(layer if layer[name] is not None else None)
+            position += len(columns)
+        return cls.merge_address(*layers), cls.address_layer(*layers)
+
+    @staticmethod
+    def address_layer(building, city, road, water, nearest_city):
+        # The layer whose row is returned by merge_address, the other found layers only add the city and postcode
+        if building is not None:
+            return "building"
+        if road is not None:
+            return "road"
+        if water is not None:
+            return "water"
+        if city is not None:
+            return "city"
+        if nearest_city is not None:
+            return "nearest"
+        return None
+
+    @staticmethod
+    def count_layers(layers):
+        # All layers are queried by one bulk query, so the layers have no time of their own: the points are counted
+        # as "OSM.layer.{layer}" of the layer which has defined the address, points without an address as
+        # "OSM.layer.none"
+        for layer in layers:
+            metrics.count("OSM.layer." + (layer or "none"))
+
+    @staticmethod
+    def merge_address(building, city, road, water, nearest_city):
+        # The same fallback rules as in select_data: building -> city -> road -> water -> nearest city
+        # Each argument is the row found in the layer or None
+        if (building is not None) and building['city']:
+            return building
+        address = building
+        if (city is not None) and (address is not None):
+            address['city'] = city['city']
+            if not address['postcode']:
+                address['postcode'] = city['postcode']
+            return address
+        if address is not None:
+            return address
+        address = city
+
+        for layer in (road, water):
+            if layer is not None:
+                if address is not None:
+                    layer['city'] = address['city']
+                return layer
+
+        if address is not None:
+            return address
+        return nearest_city
+
     def close_connection(self):
-        if (self._connection is not None) and (not self._connection.closed):
-            self._connection.close()
+        # Connections are returned to the pool after each query
         self.selected_data = None
 
-    def execute_query(self, query):
+    # Execute the prepared statement of one layer of select_data, its time is recorded as "OSM.layer.{layer}"
+    # Returns -13 if nothing has been found in the layer, -11 if the query has failed
+    def execute_layer_query(self, layer, point):
+        start_time = time.perf_counter()
         try:
-            cursor = self._connection.cursor()
-            cursor.execute(query)
-            cursor_data = cursor.fetchall()
-            if (len(cursor_data) != 1) or (cursor_data[0] is None):
-                cursor.close()
+            columns, rows = self._pool.run(self.fetch_prepared, "osm_" + layer, self.layer_statements[layer], point)
+            if (len(rows) != 1) or (rows[0] is None):
                 self.selected_data = None
-                return -11
-            self.selected_data = dict((cursor.description[i][0], value) for i, value in enumerate(cursor_data[0]))
-            cursor.close()
-            return 0
+                error = -13
+            else:
+                self.selected_data = dict(zip(columns, rows[0]))
+                error = 0
         except Exception as e:
-            cursor.close()
             self._logger.error("The error occurred while defining device's address: {}".format(e))
             self.selected_data = None
-            return -11
+            error = -11
+        metrics.observe(self.dbms + ".layer." + layer, time.perf_counter() - start_time, error == -11)
+        return error
+
+    @staticmethod
+    def fetch_prepared(connection, name, statement, parameters):
+        # The statement is prepared once per session, the next executions skip parsing and reuse the plan
+        # Returns (column names, rows)
+        with connection.cursor() as cursor:
+            if name not in connection.prepared:
+                cursor.execute("PREPARE {} ({}) AS {}".format(name, ", ".join(statement[0]), statement[1]))
+                connection.prepared.add(name)
+            cursor.execute("EXECUTE {} ({})".format(name, ", ".join(["%s"] * len(parameters))), parameters)
+            return [column[0] for column in cursor.description], cursor.fetchall()
 
 
 class ConnectionRedis(Connection):
+    # Fields of the locations decoded by select_data_array, in the order of [device_id, lng, lat, speed, ts]
+    location_dtype = [("device_id", "i8"), ("x", "f8"), ("y", "f8"), ("s", "i8"), ("ts", "i8")]
+
     def __init__(self, config_file, logger):
         self.dbms = "Redis"
         super().__init__(config_file, logger)
+        self.failed_devices = {}
+        # Chunks are decoded into NumPy arrays, if numpy is installed
+        numpy = self._config.get("numpy")
+        if numpy and (np is None):
+            raise Exception("numpy module is required for 'numpy'")
+        self.vectorized = (np is not None) if numpy is None else bool(numpy)
 
     def __del__(self):
         self.close_connection()
 
     def create_connection(self):
+        # Connections of the pool are opened on first use, the broken one is reopened and the command is repeated
         self.close_connection()
+        settings = dict(host=self._host, port=self._port, max_connections=self._pool_size, timeout=None,
+                        retry=Retry(NoBackoff(), 1), retry_on_error=[redis.exceptions.ConnectionError])
+        self._pool = pools.get_pool((self.dbms, self._host, self._port),
+                                    lambda: redis.BlockingConnectionPool(**settings))
+        self._connection = redis.Redis(connection_pool=self._pool)
         try:
-            self._connection = redis.Redis(
-                host=self._host,
-                port=self._port,
-            )
+            self._connection.ping()
             return 0
         except Exception as e:
             self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
             return -10
 
+    @metrics.timed("select_data")
     def select_data(self, device_id):
         name = "device:" + str(device_id) + ":info"
         try:
@@ -414,13 +973,8 @@ class ConnectionRedis(Connection):
                 self._logger.error("Device: {}. Failed to select data from {}.".format(device_id, self.dbms))
                 return -13
 
-            data_str = base64.b64decode(ans.decode("utf-8"))
-            data = proto_storage_pb2.Data()
-            data.ParseFromString(data_str)
-            pos = data.position
-
             # [device_id, lng, lat, speed, ts]
-            self.selected_data = [device_id, pos.x, pos.y, pos.s, pos.ts]
+            self.selected_data = self.parse_data(device_id, ans)
             return 0
         except Exception as e:
             self._logger.error("Device: {}. Failed to select data from {}. The error occurred: {}.".format(device_id,
@@ -428,20 +982,147 @@ class ConnectionRedis(Connection):
             self.selected_data = None
             return -11
 
+    @metrics.timed("select_data_bulk")
+    def select_data_bulk(self, device_ids):
+        # Select data of the whole chunk of devices with one MGET call
+        # self.selected_data = {device_id: [device_id, lng, lat, speed, ts]}
+        # self.failed_devices = {device_id: error}
+        self.selected_data = {}
+        self.failed_devices = {}
+        names = ["device:" + str(device_id) + ":info" for device_id in device_ids]
+        try:
+            answers = self._connection.mget(names)
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to select data from {}. The error occurred: {}.".format(device_ids,
+                                                                                                            self.dbms,
+                                                                                                            e))
+            self.failed_devices = dict((device_id, -11) for device_id in device_ids)
+            return -11
+
+        for device_id, ans in zip(device_ids, answers):
+            if ans is None:
+                self._logger.error("Device: {}. Failed to select data from {}.".format(device_id, self.dbms))
+                self.failed_devices[device_id] = -13
+                continue
+            try:
+                self.selected_data[device_id] = self.parse_data(device_id, ans)
+            except Exception as e:
+                self._logger.error("Device: {}. Failed to select data from {}. "
+                                   "The error occurred: {}.".format(device_id, self.dbms, e))
+                self.failed_devices[device_id] = -11
+        return 0
+
+    @metrics.timed("select_data_bulk")
+    def select_data_array(self, device_ids):
+        # Select data of the whole chunk of devices with one MGET call and decode it into a NumPy structured array
+        # self.selected_data = array of location_dtype in the order of device_ids without the failed devices
+        # self.failed_devices = {device_id: error}
+        self.selected_data = np.zeros(0, dtype=self.location_dtype)
+        self.failed_devices = {}
+        names = ["device:" + str(device_id) + ":info" for device_id in device_ids]
+        try:
+            answers = self._connection.mget(names)
+        except Exception as e:
+            self._logger.error("Devices: {}. Failed to select data from {}. The error occurred: {}.".format(device_ids,
+                                                                                                            self.dbms,
+                                                                                                            e))
+            self.failed_devices = dict((device_id, -11) for device_id in device_ids)
+            return -11
+
+        # One message is reused for all payloads, only the fields of the position are copied
+        data = proto_storage_pb2.Data()
+        rows = []
+        for device_id, ans in zip(device_ids, answers):
+            if ans is None:
+                self._logger.error("Device: {}. Failed to select data from {}.".format(device_id, self.dbms))
+                self.failed_devices[device_id] = -13
+                continue
+            try:
+                data.ParseFromString(base64.b64decode(ans))
+            except Exception as e:
+                self._logger.error("Device: {}. Failed to select data from {}. "
+                                   "The error occurred: {}.".format(device_id, self.dbms, e))
+                self.failed_devices[device_id] = -11
+                continue
+            pos = data.position
+            rows.append((device_id, pos.x, pos.y, pos.s, pos.ts))
+        self.selected_data = np.array(rows, dtype=self.location_dtype)
+        return 0
+
+    @metrics.timed("select_updated_devices")
+    def select_updated_devices(self, since, updates_key=None, scan_count=1000):
+        # Devices whose position has been updated after the moment since (UTC timestamp)
+        # updates_key is a sorted set of device ids scored by the time of the last position update,
+        # without it all device keys are scanned and the timestamps of their positions are checked
+        # self.selected_data = [device_id, ...] sorted by device_id
+        try:
+            if updates_key is not None:
+                devices = [int(device) for device in self._connection.zrangebyscore(updates_key,
+                                                                                   "({}".format(since), "+inf")]
+            else:
+                devices = []
+                keys = []
+                for key in self._connection.scan_iter(match="device:*:info", count=scan_count):
+                    keys.append(key)
+                    if len(keys) >= scan_count:
+                        devices.extend(self.filter_updated(keys, since))
+                        keys = []
+                devices.extend(self.filter_updated(keys, since))
+            self.selected_data = sorted(set(devices))
+            return 0
+        except Exception as e:
+            self._logger.error("Failed to select updated devices from {}. The error occurred: {}.".format(self.dbms,
+                                                                                                         e))
+            self.selected_data = None
+            return -11
+
+    def filter_updated(self, keys, since):
+        # Returns ids of the devices of the keys "device:{id}:info" whose position is newer than since
+        if not keys:
+            return []
+        devices = []
+        for key, ans in zip(keys, self._connection.mget(keys)):
+            if ans is None:
+                continue
+            try:
+                device_id = int(key.split(b":")[1])
+            except ValueError:
+                # Other keys matching the pattern are skipped
+                self._logger.error("Key: {}. Failed to parse device's id.".format(key))
+                continue
+            try:
+                if self.parse_data(device_id, ans)[4] > since:
+                    devices.append(device_id)
+            except Exception:
+                # The device is selected, the error is logged when its location is selected
+                devices.append(device_id)
+        return devices
+
+    @staticmethod
+    def parse_data(device_id, ans):
+        data_str = base64.b64decode(ans.decode("utf-8"))
+        data = proto_storage_pb2.Data()
+        data.ParseFromString(data_str)
+        pos = data.position
+
+        # [device_id, lng, lat, speed, ts]
+        return [device_id, pos.x, pos.y, pos.s, pos.ts]
+
     def close_connection(self):
+        # Connections are returned to the pool after each command
         self.selected_data = None
-        try:
-            self._connection.ping()
-            self._connection.close()
-        except Exception:
-            return
 
 
 class ConnectionTimeZoneServer(Connection):
-    def __init__(self, config_file, logger):
+    def __init__(self, config_file, logger, cache=None):
         self.dbms = "TimeZoneServer"
         super().__init__(config_file, logger)
         self._url = "http://" + self._host + ':' + str(self._port) + '/tz.json'
+        # Offline mode defines timezones with the timezone boundary dataset of timezonefinder and zoneinfo
+        self._offline = bool(self._config.get("offline", False))
+        self._finder = None
+        # Cache.TimeZoneCache shared by all threads
+        self._cache = cache
 
     def __del__(self):
         self.close_connection()
@@ -449,12 +1130,36 @@ class ConnectionTimeZoneServer(Connection):
     def create_connection(self):
         self.close_connection()
         try:
-            self._connection = requests.Session()
+            if self._offline:
+                if TimezoneFinder is None:
+                    raise Exception("timezonefinder module is required in offline mode")
+                self._finder = TimezoneFinder()
+            else:
+                # The session is shared by all threads, it keeps up to pool_size connections
+                self._connection = pools.get_pool((self.dbms, self._url), lambda: create_session(self._pool_size))
+                # Any answer of the server is enough, an unreachable server stops the run at startup
+                self._connection.get(self._url, data={"lon": 0, "lat": 0, "t": 0})
+            return 0
         except Exception as e:
             self._logger.error("Failed to connect to {}. The error occurred: {}.".format(self.dbms, e))
             return -10
 
+    @metrics.timed("select_data")
     def select_data(self, lng, lat, ts_utc):
+        if self._cache is not None:
+            shift = self._cache.get(lng, lat, ts_utc)
+            if shift is not None:
+                self.selected_data = shift
+                return 0
+        if self._offline:
+            error = self.define_timezone(lng, lat, ts_utc)
+        else:
+            error = self.request_timezone(lng, lat, ts_utc)
+        if (not error) and (self._cache is not None):
+            self._cache.put(lng, lat, ts_utc, self.selected_data)
+        return error
+
+    def request_timezone(self, lng, lat, ts_utc):
         data = {"lon": lng, "lat": lat, "t": ts_utc}
         try:
             response = self._connection.get(self._url, data=data)
@@ -470,9 +1175,21 @@ class ConnectionTimeZoneServer(Connection):
             self.selected_data = None
             return -11
 
+    def define_timezone(self, lng, lat, ts_utc):
+        try:
+            timezone_name = self._finder.timezone_at(lng=lng, lat=lat)
+            if timezone_name is None:
+                self._logger.error("Failed to define timezone. Lat: {}, lng: {}, ts_utc: {}.".format(lat, lng, ts_utc))
+                return -13
+            shift = datetime.fromtimestamp(ts_utc, ZoneInfo(timezone_name)).utcoffset()
+            self.selected_data = int(shift.total_seconds()) / 3600
+            return 0
+        except Exception as e:
+            self._logger.error("Failed to define timezone. Lat: {}, lng: {}, ts_utc: {}. "
+                               "The error occurred: {}.".format(lat, lng, ts_utc, e))
+            self.selected_data = None
+            return -11
+
     def close_connection(self):
+        # The session is closed with the other pools
         self.selected_data = None
-        try:
-            self._connection.close()
-        except Exception:
-            return
@@ -0,0 +1,225 @@
+import os
+import math
+import json
+import time
+import threading
+import functools
+import contextlib
+import cProfile
+import pstats
+
+
+# Latency histograms of calls to the databases and TimeZoneServer shared by all threads of the process.
+# Buckets grow by 2^(1/4), so percentiles are defined with the precision of 19% in constant memory.
+
+MIN_TIME = 0.000001
+BUCKET_BASE = 2 ** 0.25
+
+_lock = threading.Lock()
+# {name: Histogram}
+_histograms = {}
+# {name: count} of events which have no time of their own
+_counters = {}
+# Profiles of the worker loops, if profiling is enabled
+_profiles = []
+profiling = False
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # {bucket index: count}, bucket i contains times up to MIN_TIME * BUCKET_BASE^i
+        self.buckets = {}
+
+    def observe(self, seconds, error=False):
+        i = 0 if seconds <= MIN_TIME else int(math.ceil(math.log(seconds / MIN_TIME, BUCKET_BASE)))
+        self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if error:
+            self.errors += 1
+
+    # Returns the upper bound of the bucket which contains the q-th quantile
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(MIN_TIME * BUCKET_BASE ** i, self.max)
+        return self.max
+
+    def merge(self, data):
+        self.count += data['count']
+        self.errors += data['errors']
+        self.sum += data['sum']
+        self.max = max(self.max, data['max'])
+        for i, cnt in data['buckets'].items():
+            self.buckets[int(i)] = self.buckets.get(int(i), 0) + cnt
+
+    def dump(self):
+        return {'count': self.count, 'errors': self.errors, 'sum': self.sum, 'max': self.max,
+                'buckets': dict(self.buckets)}
+
+
+def observe(name, seconds, error=False):
+    with _lock:
+        if name not in _histograms:
+            _histograms[name] = Histogram()
+        _histograms[name].observe(seconds, error)
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+# Time of the block is recorded as name, the block has failed if it has raised an exception
+@contextlib.contextmanager
+def timer(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        observe(name, time.perf_counter() - start_time, True)
+        raise
+    observe(name, time.perf_counter() - start_time)
+
+
+# Decorator of the methods of Connection classes, the call is timed as "{dbms}.{name}"
+# The call has failed if it has raised an exception or returned a non-zero error code
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                result = func(obj, *args, **kwargs)
+            except Exception:
+                observe(obj.dbms + "." + name, time.perf_counter() - start_time, True)
+                raise
+            observe(obj.dbms + "." + name, time.perf_counter() - start_time,
+                    isinstance(result, int) and result != 0)
+            return result
+        return wrapper
+    return decorator
+
+
+# Returns histograms of the process, they can be sent to the main process and merged there
+def snapshot():
+    with _lock:
+        return dict((name, histogram.dump()) for name, histogram in _histograms.items())
+
+
+# Returns counters of the process
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+# Merge counters of several processes
+def merge_counters(snapshots):
+    result = {}
+    for data in snapshots:
+        for name, cnt in data.items():
+            result[name] = result.get(name, 0) + cnt
+    return dict((name, result[name]) for name in sorted(result))
+
+
+# Merge snapshots of several processes
+def merge(snapshots):
+    histograms = {}
+    for data in snapshots:
+        for name, histogram in data.items():
+            if name not in histograms:
+                histograms[name] = Histogram()
+            histograms[name].merge(histogram)
+    return histograms
+
+
+def report(histograms):
+    result = {}
+    for name in sorted(histograms):
+        histogram = histograms[name]
+        result[name] = {
+            'count': histogram.count,
+            'errors': histogram.errors,
+            'sum': round(histogram.sum, 6),
+            'mean': round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+            'p50': round(histogram.percentile(0.5), 6),
+            'p95': round(histogram.percentile(0.95), 6),
+            'p99': round(histogram.percentile(0.99), 6),
+            'max': round(histogram.max, 6)
+        }
+    return result
+
+
+# Files are replaced at once, so they are never read half-written
+def replace_file(file, text):
+    tmp_file = file + ".tmp"
+    with open(tmp_file, 'w') as stream:
+        stream.write(text)
+    os.replace(tmp_file, file)
+
+
+def save_report(file, histograms, runtime, counts=None):
+    replace_file(file, json.dumps({'runtime': round(runtime, 3), 'calls': report(histograms), 'counters': counts or {}},
+                                  indent=1))
+
+
+# Prometheus textfile for the textfile collector of node_exporter
+def save_textfile(file, histograms, runtime, counts=None):
+    lines = ["# HELP geo_summary_call_seconds Latency of calls to the databases and TimeZoneServer and of chunks.",
+             "# TYPE geo_summary_call_seconds summary"]
+    for name, values in report(histograms).items():
+        for quantile, key in (("0.5", 'p50'), ("0.95", 'p95'), ("0.99", 'p99')):
+            lines.append('geo_summary_call_seconds{{call="{}",quantile="{}"}} {}'.format(name, quantile,
+                                                                                         values[key]))
+        lines.append('geo_summary_call_seconds_sum{{call="{}"}} {}'.format(name, values['sum']))
+        lines.append('geo_summary_call_seconds_count{{call="{}"}} {}'.format(name, values['count']))
+    lines += ["# HELP geo_summary_call_errors_total Failed calls to the databases and TimeZoneServer.",
+              "# TYPE geo_summary_call_errors_total counter"]
+    for name, values in report(histograms).items():
+        lines.append('geo_summary_call_errors_total{{call="{}"}} {}'.format(name, values['errors']))
+    lines += ["# HELP geo_summary_events_total Events counted by the script, e.g. points geocoded by each OSM layer.",
+              "# TYPE geo_summary_events_total counter"]
+    for name, cnt in (counts or {}).items():
+        lines.append('geo_summary_events_total{{event="{}"}} {}'.format(name, cnt))
+    lines += ["# HELP geo_summary_runtime_seconds Runtime of the last run.",
+              "# TYPE geo_summary_runtime_seconds gauge",
+              "geo_summary_runtime_seconds {}".format(round(runtime, 3))]
+    replace_file(file, "\n".join(lines) + "\n")
+
+
+# Run func(*args) under cProfile, if profiling is enabled
+# Before Python 3.12 cProfile profiles only the thread where it is enabled, so every worker thread has its own
+# profile. Since Python 3.12 the first profile covers all threads and the other ones can't be enabled.
+def profiled(func, *args):
+    if not profiling:
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profile.disable()
+        with _lock:
+            _profiles.append(profile)
+
+
+# Save profiles of all worker threads of the process as one pstats file
+def save_profile(file):
+    with _lock:
+        profiles = list(_profiles)
+    if profiles:
+        pstats.Stats(*profiles).dump_stats(file)
@@ -0,0 +1,254 @@
+import time
+import threading
+import queue
+
+import Connection as connections
+import Processing as processing
+import Pool as pools
+import Metrics as metrics
+
+
+# One stage of the pipeline. Every worker of the stage owns its own connections, takes chunks of devices from the
+# input queue, processes them and puts them into the bounded input queue of the next stage.
+# None in the queue means that the previous stage has finished.
+# fail(name, item, e) is called if process() has raised an exception, the item is passed on anyway.
+class Stage:
+    def __init__(self, name, workers, connect, process, fail, in_queue, out_queue=None):
+        self.name = name
+        self.workers = workers
+        self.next_stage = None
+        self._connect = connect
+        self._process = process
+        self._fail = fail
+        self.in_queue = in_queue
+        self._out_queue = out_queue
+        self._active = workers
+        self._lock = threading.Lock()
+        self._threads = []
+        # Queue depth samples
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.samples = 0
+
+    def start(self, que):
+        for i in range(self.workers):
+            t = threading.Thread(target=metrics.profiled, args=(self.work, que), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def join(self):
+        for t in self._threads:
+            t.join()
+
+    def is_alive(self):
+        return any(t.is_alive() for t in self._threads)
+
+    def work(self, que):
+        con = self._connect()
+        if 'error' in con:
+            que.put({'error': con['error']})
+            return
+        while 1:
+            item = self.in_queue.get()
+            if item is None:
+                break
+            try:
+                self._process(con, item)
+            except Exception as e:
+                # The next stages and the end mark must not wait for the item forever
+                self._fail(self.name, item, e)
+            if self._out_queue is not None:
+                self._out_queue.put(item)
+        # The last worker of the stage stops the next stage
+        with self._lock:
+            self._active -= 1
+            if (self._active == 0) and (self.next_stage is not None):
+                for i in range(self.next_stage.workers):
+                    self._out_queue.put(None)
+        if 'finish' in con:
+            con['finish']()
+
+    def sample(self):
+        depth = self.in_queue.qsize()
+        self.depth_sum += depth
+        self.samples += 1
+        if depth > self.depth_max:
+            self.depth_max = depth
+
+
+# Processes devices in stages connected by bounded queues:
+# device listing -> location fetch -> change detection (last locations only) -> timezone -> geocode -> write
+# Every stage has its own number of workers, slow backends don't stall the other ones.
+class Pipeline:
+    def __init__(self, config_file, logger, is_first, cache=None, checkpoint=None, updated_devices=None,
+                 failed=None):
+        self._config_file = config_file
+        self._checkpoint = checkpoint
+        # Sorted list of devices updated since the last run, all devices are processed if it is None
+        self._updated_devices = updated_devices
+        # Processing.FailedDevices of the incremental run
+        self._failed = failed
+        self._logger = logger
+        self._is_first = is_first
+        if cache is None:
+            cache = {'osm': None, 'tz': None}
+        self._cache = cache
+        settings = pools.read_config(config_file).get("Pipeline") or {}
+        self._queue_size = int(settings.get("queue_size", 8))
+        self._monitor_interval = float(settings.get("monitor_interval", 1))
+        self._workers = dict((name, int(settings.get(name, default)))
+                             for name, default in (("fetch", 2), ("detect", 2), ("tz", 8), ("geocode", 4),
+                                                   ("write", 2)))
+        self._lock = threading.Lock()
+        self._que = None
+        self.errors_cnt = 0
+        self.inserted_rows_cnt = 0
+        self.unchanged_loc_cnt = 0
+        self.max_time = 0
+
+    # Thread target, messages are the same as the ones of insert_first/last_dev_locations
+    # devices_range = (first_id, last_id], first_id is not included
+    def run(self, que, devices_range):
+        self._que = que
+        stages = self.create_stages()
+        for stage in stages:
+            stage.start(que)
+
+        # Device listing
+        con = self.connect(connections.ConnectionMysql, 'mysql')
+        if 'error' in con:
+            que.put({'error': con['error']})
+            return
+        for error, devices, chunk_range in processing.select_devices(con, devices_range, self._checkpoint,
+                                                                     self._updated_devices):
+            if error:
+                que.put({'error': error})
+                return
+            stages[0].in_queue.put({'devices': devices, 'range': chunk_range, 'start_time': time.time()})
+            self.sample(stages)
+        con['mysql'].close_connection()
+        for i in range(stages[0].workers):
+            stages[0].in_queue.put(None)
+
+        while stages[-1].is_alive():
+            self.sample(stages)
+            time.sleep(self._monitor_interval)
+        for stage in stages:
+            stage.join()
+            if stage.samples:
+                self._logger.info("Stage {}: {} workers, average queue depth {:.2f}, max queue depth "
+                                  "{}.".format(stage.name, stage.workers, stage.depth_sum / stage.samples,
+                                               stage.depth_max))
+        self._logger.info("Max processing time of one chunk of devices: {}".format(self.max_time))
+        que.put({'finish': (self.errors_cnt, self.inserted_rows_cnt, self.unchanged_loc_cnt, self.max_time)})
+
+    def sample(self, stages):
+        for stage in stages:
+            stage.sample()
+
+    def create_stages(self):
+        names = ["fetch", "tz", "geocode", "write"]
+        if not self._is_first:
+            names.insert(1, "detect")
+        stages = []
+        next_stage = None
+        for name in reversed(names):
+            stage = Stage(name, self._workers[name], getattr(self, "connect_" + name),
+                          getattr(self, "process_" + name), self.fail_item, queue.Queue(self._queue_size),
+                          None if next_stage is None else next_stage.in_queue)
+            stage.next_stage = next_stage
+            stages.insert(0, stage)
+            next_stage = stage
+        return stages
+
+    def connect(self, connection_class, name, *args):
+        try:
+            con = {name: connection_class(self._config_file, self._logger, *args)}
+            error = con[name].create_connection()
+            if error:
+                return {'error': error}
+            con['failed'] = self._failed
+            return con
+        except Exception as e:
+            self._logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+            return {'error': -10}
+
+    # The chunk which has failed at some stage is counted as errors and passed on without locations, its range is
+    # not marked in the checkpoint. The last stage reports its progress, as process_write hasn't done it.
+    def fail_item(self, name, item, e):
+        self._logger.error("Devices: {}. Failed to process the chunk at stage {}. "
+                           "The error occurred: {}.".format(item['devices'], name, e))
+        if not item.get('failed'):
+            item['failed'] = True
+            self.count(errors=len(item['devices']))
+            if self._failed is not None:
+                self._failed.add(item['devices'])
+        item['locations'] = []
+        item['rows'] = []
+        if name == "write":
+            self._que.put({'progress': len(item['devices'])})
+
+    def count(self, errors=0, inserted=0, unchanged=0):
+        with self._lock:
+            self.errors_cnt += errors
+            self.inserted_rows_cnt += inserted
+            self.unchanged_loc_cnt += unchanged
+
+    def connect_fetch(self):
+        if self._is_first:
+            return self.connect(connections.ConnectionOracle, 'oracle')
+        return self.connect(connections.ConnectionRedis, 'redis')
+
+    def process_fetch(self, con, item):
+        if self._is_first:
+            item['locations'], errors = processing.select_first_locations(con, item['devices'], self._logger)
+        else:
+            item['locations'], errors = processing.select_last_locations(con, item['devices'], self._logger)
+        self.count(errors=errors)
+
+    def connect_detect(self):
+        return self.connect(connections.ConnectionPostgresql, 'psql')
+
+    def process_detect(self, con, item):
+        item['locations'], unchanged = processing.select_changed_locations(con, item['locations'])
+        self.count(unchanged=unchanged)
+
+    def connect_tz(self):
+        return self.connect(connections.ConnectionTimeZoneServer, 'tz', self._cache['tz'])
+
+    def process_tz(self, con, item):
+        item['rows'], errors = processing.define_timezones(con, item['locations'])
+        self.count(errors=errors)
+
+    def connect_geocode(self):
+        return self.connect(connections.ConnectionOSM, 'osm', self._cache['osm'])
+
+    def process_geocode(self, con, item):
+        item['rows'], errors = processing.define_addresses(con, item['rows'])
+        self.count(errors=errors)
+
+    def connect_write(self):
+        con = self.connect(connections.ConnectionPostgresql, 'psql')
+        if 'error' not in con:
+            con['pending'] = processing.PendingRanges(self._checkpoint)
+            con['finish'] = lambda: self.finish_write(con)
+        return con
+
+    # Insert the rest of buffered rows when the stage stops
+    def finish_write(self, con):
+        inserted, errors = con['psql'].flush_data()
+        self.count(errors=errors, inserted=inserted)
+        con['pending'].commit(con)
+
+    def process_write(self, con, item):
+        inserted, errors = processing.add_rows(con, item['rows'])
+        self.count(errors=errors, inserted=inserted)
+        if not item.get('failed'):
+            con['pending'].add(item['range'], len(item['devices']))
+        con['pending'].commit(con)
+        cur_time = time.time() - item['start_time']
+        metrics.observe("chunk", cur_time)
+        with self._lock:
+            if cur_time > self.max_time:
+                self.max_time = cur_time
+        self._que.put({'progress': len(item['devices'])})
@@ -0,0 +1,152 @@
+import os
+import threading
+
+import yaml
+
+
+# Connections shared by all Connection objects of the process. Connections are opened on first use, every
+# thread takes one only for the time of a query, so the number of threads may exceed the number of connections.
+
+_lock = threading.Lock()
+_configs = {}
+_pools = {}
+
+
+# Parse the configuration file once per process
+def read_config(config_file):
+    with _lock:
+        if config_file not in _configs:
+            with open(config_file, 'r') as stream:
+                _configs[config_file] = yaml.safe_load(stream)
+        return _configs[config_file]
+
+
+# Returns the pool of the key, the pool is created by factory() if it doesn't exist
+# Pools are not shared with the forked processes, every process opens its own connections
+def get_pool(key, factory):
+    key = (os.getpid(),) + tuple(key)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = factory()
+        return _pools[key]
+
+
+def close_pools():
+    with _lock:
+        pools = [pool for key, pool in _pools.items() if key[0] == os.getpid()]
+        for key in [key for key in _pools if key[0] == os.getpid()]:
+            del _pools[key]
+    for pool in pools:
+        # redis.ConnectionPool is closed by disconnect()
+        if hasattr(pool, "disconnect"):
+            pool.disconnect()
+        else:
+            pool.close()
+
+
+# Execute the query and return all rows
+def fetch_all(connection, query, parameters=(), **cursor_options):
+    cursor = connection.cursor(**cursor_options)
+    try:
+        cursor.execute(query, parameters)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class LazyPool:
+    # Blocking pool of at most size connections, connect() opens a new connection when there are no idle ones
+    # Connections which raised one of retry_errors are closed and the query is repeated once with a new connection
+    def __init__(self, connect, size, retry_errors=()):
+        self._connect = connect
+        self._idle = []
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._retry_errors = retry_errors
+
+    def acquire(self):
+        self._semaphore.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def release(self, connection, broken=False):
+        if broken:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        else:
+            with self._lock:
+                self._idle.append(connection)
+        self._semaphore.release()
+
+    # Returns func(connection, *args, **kwargs)
+    def run(self, func, *args, **kwargs):
+        attempt = 0
+        while 1:
+            connection = self.acquire()
+            try:
+                result = func(connection, *args, **kwargs)
+            except self._retry_errors:
+                self.release(connection, broken=True)
+                attempt += 1
+                if attempt > 1:
+                    raise
+                continue
+            except Exception:
+                self.release(connection)
+                raise
+            self.release(connection)
+            return result
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection in idle:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class SessionPool(LazyPool):
+    # Oracle sessions are kept by cx_Oracle.SessionPool, create_pool() creates it on first use
+    def __init__(self, create_pool, retry_errors=()):
+        super().__init__(None, 1, retry_errors)
+        self._create_pool = create_pool
+        self._pool = None
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+            return self._pool
+
+    def acquire(self):
+        return self.pool().acquire()
+
+    def release(self, connection, broken=False):
+        try:
+            if broken:
+                self.pool().drop(connection)
+            else:
+                self.pool().release(connection)
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            try:
+                pool.close(force=True)
+            except Exception:
+                pass
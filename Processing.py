@@ -0,0 +1,279 @@
+import time
+import math
+import bisect
+import threading
+
+# Checks of chunks of locations decoded into NumPy arrays
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Steps of processing of one chunk of devices, they are shared by the threads and the pipeline engines
+# locations = [(device_id, lng, lat, speed, ts), ...]
+# rows = [[device_id, lng, lat, address, speed, last_location_time, timezone_shift], ...]
+
+
+# Select devices of the range (first_id, last_id] by chunks with keyset pagination
+# The parts of the range processed by the interrupted run are skipped, if checkpoint is given
+# Only the devices of the sorted list updated_devices which are present in MySQL are selected, if it is given
+# Yields (error, devices, chunk_range), chunk_range = (first_id, last_id] covers the devices of the chunk
+def select_devices(con, devices_range, checkpoint=None, updated_devices=None):
+    ranges = [devices_range] if checkpoint is None else checkpoint.remaining(devices_range)
+    for first_id, max_id in ranges:
+        last_id = first_id
+        while 1:
+            if updated_devices is None:
+                error = con['mysql'].select_data(last_id, max_id)
+                listed = con['mysql'].selected_data
+            else:
+                i = bisect.bisect_right(updated_devices, last_id)
+                listed = [device for device in updated_devices[i:i + con['mysql'].chunk] if device <= max_id]
+                error = con['mysql'].select_existing(listed) if listed else 0
+            if error:
+                yield error, None, None
+                return
+            if not listed:
+                break
+            devices = listed if updated_devices is None else con['mysql'].selected_data
+            # The last chunk covers the rest of the range
+            chunk_range = (last_id, max_id if len(listed) < con['mysql'].chunk else listed[-1])
+            if devices:
+                yield 0, devices, chunk_range
+            if len(listed) < con['mysql'].chunk:
+                break
+            last_id = listed[-1]
+
+
+# Split the sorted list of devices into parts with the same number of devices
+# Returns [boundary_0, ..., boundary_parts], part i is (boundary_i, boundary_i+1]
+def split_devices(devices, parts):
+    if not devices:
+        return [0] * (parts + 1)
+    boundaries = [devices[0] - 1]
+    for i in range(1, parts):
+        boundaries.append(max(devices[max(i * len(devices) // parts - 1, 0)], boundaries[-1]))
+    boundaries.append(devices[-1])
+    return boundaries
+
+
+# Select data of the first location for the whole chunk of devices from Oracle
+# Returns (locations, errors_cnt)
+def select_first_locations(con, devices, logger):
+    errors_cnt = 0
+    locations = []
+    # con['oracle'].selected_data = {device_id: (lng, lat, speed, time)}
+    con['oracle'].select_data_bulk(devices)
+    for device in devices:
+        if device not in con['oracle'].selected_data:
+            errors_cnt += 1
+            continue
+        location = con['oracle'].selected_data[device]
+        if location[3] > time.time():
+            logger.error("Device: {}. Incorrect timestamp.".format(device))
+            errors_cnt += 1
+            continue
+        locations.append((device, location[0], location[1], location[2], location[3]))
+    return locations, errors_cnt
+
+
+# Select current locations of the whole chunk of devices from Redis
+# Returns (locations, errors_cnt), locations are an array of ConnectionRedis.location_dtype if Redis data is decoded
+# into NumPy arrays
+def select_last_locations(con, devices, logger):
+    if con['redis'].vectorized:
+        locations, errors_cnt = select_last_locations_array(con, devices, logger)
+        if errors_cnt:
+            add_failed(con, devices, locations['device_id'].tolist())
+        return locations, errors_cnt
+    errors_cnt = 0
+    locations = []
+    # con['redis'].selected_data = {device_id: [device_id, lng, lat, speed, time]}
+    con['redis'].select_data_bulk(devices)
+    for device in devices:
+        if device not in con['redis'].selected_data:
+            errors_cnt += 1
+            continue
+        location = con['redis'].selected_data[device]
+        if location[4] > time.time():
+            logger.error("Device: {}. Incorrect timestamp.".format(device))
+            errors_cnt += 1
+            continue
+        locations.append(tuple(location))
+    if errors_cnt:
+        add_failed(con, devices, [location[0] for location in locations])
+    return locations, errors_cnt
+
+
+# The timestamps of the whole chunk are checked at once
+# Returns (array of ConnectionRedis.location_dtype, errors_cnt)
+def select_last_locations_array(con, devices, logger):
+    con['redis'].select_data_array(devices)
+    locations = con['redis'].selected_data
+    incorrect = locations['ts'] > time.time()
+    for device in locations['device_id'][incorrect].tolist():
+        logger.error("Device: {}. Incorrect timestamp.".format(device))
+    return locations[~incorrect], len(devices) - len(locations) + int(incorrect.sum())
+
+
+EARTH_RADIUS = 6371000
+
+
+# Great-circle distance between two points in meters
+def haversine(lng1, lat1, lng2, lat2):
+    d_lat = math.radians(lat2 - lat1)
+    d_lng = math.radians(lng2 - lng1)
+    a = math.sin(d_lat / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lng / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(a), 1))
+
+
+# haversine of arrays of points
+def haversine_array(lng1, lat1, lng2, lat2):
+    d_lat = np.radians(lat2 - lat1)
+    d_lng = np.radians(lng2 - lng1)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(d_lng / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(np.sqrt(a), 1))
+
+
+# The device hasn't changed its location, if it is not further than threshold meters from the last location,
+# if the location is not newer than the last one or if less than min_time_delta seconds have passed since it
+# location = (device_id, lng, lat, speed, ts), last_location = (device_id, lng, lat, last_location_time)
+def is_unchanged(location, last_location, threshold=0, min_time_delta=0):
+    time_delta = location[4] - last_location[3]
+    if (time_delta <= 0) or (time_delta < min_time_delta):
+        return True
+    return haversine(last_location[1], last_location[2], location[1], location[2]) <= threshold
+
+
+# Keep locations of devices which have changed their location since the last check
+# Returns (locations, unchanged_loc_cnt), locations are a list of tuples for arrays of locations too
+def select_changed_locations(con, locations):
+    if (np is not None) and isinstance(locations, np.ndarray):
+        return select_changed_locations_array(con, locations)
+    unchanged_loc_cnt = 0
+    changed_locations = []
+    # Select last locations of devices from geo_summary
+    error = con['psql'].select_data([location[0] for location in locations])
+    for location in locations:
+        device = location[0]
+        if (not error) and (device in con['psql'].selected_data):
+            if is_unchanged(location, con['psql'].selected_data[device], con['psql'].movement_threshold,
+                            con['psql'].min_time_delta):
+                unchanged_loc_cnt += 1
+                continue
+        changed_locations.append(location)
+    return changed_locations, unchanged_loc_cnt
+
+
+# is_unchanged of the whole array of locations at once
+def select_changed_locations_array(con, locations):
+    devices = locations['device_id'].tolist()
+    changed = np.ones(len(locations), dtype=bool)
+    error = con['psql'].select_data(devices)
+    if not error:
+        # last_locations = [(device_id, lng, lat, last_location_time) or None, ...]
+        last_locations = [con['psql'].selected_data.get(device) for device in devices]
+        known = np.flatnonzero([last_location is not None for last_location in last_locations])
+        if len(known):
+            last = np.array([last_locations[i][1:] for i in known], dtype=float)
+            current = locations[known]
+            time_delta = current['ts'] - last[:, 2]
+            unchanged = (time_delta <= 0) | (time_delta < con['psql'].min_time_delta) | \
+                (haversine_array(last[:, 0], last[:, 1], current['x'], current['y']) <= con['psql'].movement_threshold)
+            changed[known[unchanged]] = False
+    return locations[changed].tolist(), len(locations) - int(changed.sum())
+
+
+# Define timezones of devices' locations
+# Returns (rows without addresses, errors_cnt)
+def define_timezones(con, locations):
+    errors_cnt = 0
+    rows = []
+    for device, lng, lat, speed, ts in locations:
+        # args = (lng, lat, ts_utc)
+        if con['tz'].select_data(lng, lat, ts):
+            errors_cnt += 1
+            continue
+        rows.append([device, lng, lat, None, speed, ts, con['tz'].selected_data])
+    if errors_cnt:
+        add_failed(con, [location[0] for location in locations], [row[0] for row in rows])
+    return rows, errors_cnt
+
+
+# Define addresses of the whole chunk of devices
+# Returns (rows with addresses, errors_cnt)
+def define_addresses(con, rows):
+    # args = [(lng, lat), ...]
+    con['osm'].select_data_bulk([(row[1], row[2]) for row in rows])
+    defined_rows = []
+    for row, address in zip(rows, con['osm'].selected_data):
+        if address is None:
+            continue
+        row[3] = address
+        defined_rows.append(row)
+    if len(defined_rows) < len(rows):
+        add_failed(con, [row[0] for row in rows], [row[0] for row in defined_rows])
+    return defined_rows, len(rows) - len(defined_rows)
+
+
+# Add new rows to the geo_summary insert buffer, flush the buffer if it is full
+# The buffer is flushed only between chunks, so the committed rows always cover whole chunks of devices
+# Returns (inserted_rows_cnt, errors_cnt) of the buffer flush
+def add_rows(con, rows):
+    for row in rows:
+        con['psql'].add_row(tuple(row))
+    if con['psql'].buffered_rows() >= con['psql'].batch_size:
+        return con['psql'].flush_data()
+    return 0, 0
+
+
+# Devices whose location hasn't been written because of an error, shared by all threads of the process.
+# The incremental run saves them, so the next run processes them again even if they haven't been updated.
+class FailedDevices:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = set()
+
+    def add(self, devices):
+        with self._lock:
+            self._devices.update(devices)
+
+    # Returns the sorted list of devices
+    def devices(self):
+        with self._lock:
+            return sorted(self._devices)
+
+
+# Remember the devices which a step has dropped because of an error, if con['failed'] is set
+def add_failed(con, devices, kept):
+    if con.get('failed') is None:
+        return
+    kept = set(kept)
+    con['failed'].add([device for device in devices if device not in kept])
+
+
+# Ranges of chunks of devices whose rows are still in the insert buffer
+class PendingRanges:
+    def __init__(self, checkpoint):
+        self._checkpoint = checkpoint
+        self._ranges = []
+
+    def add(self, chunk_range, devices_cnt):
+        self._ranges.append((chunk_range[0], chunk_range[1], devices_cnt))
+
+    # Mark the chunks as processed, if their rows have been committed. If some rows have failed to be written,
+    # the chunks are not marked, so the run resumed with -r processes them again
+    def commit(self, con):
+        if con['psql'].buffered_rows():
+            return
+        if con['psql'].failed_devices:
+            add_failed(con, con['psql'].failed_devices, [])
+            con['psql'].failed_devices = []
+            self._ranges = []
+            return
+        if self._checkpoint is not None:
+            for first_id, last_id, devices_cnt in self._ranges:
+                self._checkpoint.done(first_id, last_id, devices_cnt)
+        self._ranges = []
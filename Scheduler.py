@@ -0,0 +1,157 @@
+import time
+import threading
+import queue
+from collections import deque
+
+import Processing as processing
+import Metrics as metrics
+
+
+# Small ranges of device ids shared by the worker threads. A worker takes the next range when it has finished
+# the previous one, so a range of slow devices delays only its own worker and the others take the rest of the ranges.
+class WorkQueue:
+    # ranges = [(first_id, last_id), ...], first_id is not included
+    def __init__(self, ranges):
+        self._ranges = deque(ranges)
+        self._lock = threading.Lock()
+        self._retired = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ranges)
+
+    # The next worker which takes a range stops instead
+    def retire(self):
+        with self._lock:
+            self._retired += 1
+
+    # Ranges taken by one worker
+    def ranges(self):
+        while 1:
+            with self._lock:
+                if self._retired:
+                    self._retired -= 1
+                    return
+                if not self._ranges:
+                    return
+                devices_range = self._ranges.popleft()
+            yield devices_range
+
+    # Devices of the ranges taken by one worker, selected by chunks
+    # Yields (error, devices, chunk_range) like Processing.select_devices
+    def chunks(self, con, checkpoint=None, updated_devices=None):
+        for devices_range in self.ranges():
+            for selected in processing.select_devices(con, devices_range, checkpoint, updated_devices):
+                yield selected
+                if selected[0]:
+                    return
+
+
+# Chunks of devices streamed by one producer to the worker threads. The queue is bounded, so the producer reads
+# the devices not faster than the workers process them.
+class StreamQueue:
+    def __init__(self, size):
+        self._queue = queue.Queue(size)
+        self._lock = threading.Lock()
+        self._retired = 0
+        self._finished = False
+
+    # 1 while the producer is reading devices or there are chunks in the queue, otherwise 0
+    def __len__(self):
+        return int(not self._finished or not self._queue.empty())
+
+    def retire(self):
+        with self._lock:
+            self._retired += 1
+
+    def put(self, devices, chunk_range):
+        self._queue.put((devices, chunk_range))
+
+    # Called by the producer after the last chunk, every worker gets the end mark and puts it back for the others
+    def finish(self):
+        self._finished = True
+        self._queue.put(None)
+
+    # Chunks taken by one worker, the arguments of WorkQueue.chunks are not needed
+    # Yields (error, devices, chunk_range) like Processing.select_devices
+    def chunks(self, con=None, checkpoint=None, updated_devices=None):
+        while 1:
+            with self._lock:
+                if self._retired:
+                    self._retired -= 1
+                    return
+            item = self._queue.get()
+            if item is None:
+                self._queue.put(None)
+                return
+            yield (0,) + item
+
+
+# Mean time of the calls to the databases and TimeZoneServer recorded by Metrics
+# Returns (calls_cnt, time_sum)
+def backend_calls():
+    calls_cnt = 0
+    time_sum = 0.0
+    for name, histogram in metrics.snapshot().items():
+        # Times of the chunks and of the layers of OSM queries are parts of the other calls
+        if (name == "chunk") or name.startswith("OSM.layer."):
+            continue
+        calls_cnt += histogram['count']
+        time_sum += histogram['sum']
+    return calls_cnt, time_sum
+
+
+# Number of the worker threads tuned by the rate of processed devices.
+# While a new worker raises the rate by more than gain, one more worker is added. If the rate doesn't grow, the last
+# added worker is retired and the number is fixed. If the mean latency of the backend calls grows more than
+# latency_limit times since the first interval, the backends are overloaded and a worker is retired.
+class Autotuner:
+    def __init__(self, workers, min_workers, max_workers, interval=10, gain=0.05, latency_limit=2.0):
+        self.workers = workers
+        self._min_workers = min_workers
+        self._max_workers = max_workers
+        self._interval = interval
+        self._gain = gain
+        self._latency_limit = latency_limit
+        self._growing = True
+        self._added = False
+        self._rate = None
+        self._base_latency = None
+        self._last_time = time.time()
+        self._last_progress = 0
+        self._last_calls = backend_calls()
+
+    # progress is the number of processed devices
+    # Returns the change of the number of workers: 1, -1 or 0
+    def sample(self, progress):
+        now = time.time()
+        if now - self._last_time < self._interval:
+            return 0
+        calls = backend_calls()
+        rate = (progress - self._last_progress) / (now - self._last_time)
+        latency = (calls[1] - self._last_calls[1]) / (calls[0] - self._last_calls[0]) \
+            if calls[0] > self._last_calls[0] else None
+        self._last_time = now
+        self._last_progress = progress
+        self._last_calls = calls
+        if latency is None:
+            return 0
+        if self._base_latency is None:
+            self._base_latency = latency
+
+        change = 0
+        if (latency > self._base_latency * self._latency_limit) and (self.workers > self._min_workers):
+            change = -1
+            self._growing = False
+        elif self._growing:
+            if (self._rate is None) or (rate > self._rate * (1 + self._gain)):
+                if self.workers < self._max_workers:
+                    change = 1
+            else:
+                self._growing = False
+                if self._added and (self.workers > self._min_workers):
+                    change = -1
+        self._added = change > 0
+        self._rate = rate
+        self.workers += change
+        return change
@@ -0,0 +1,391 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import sqlite3
+import argparse
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+import Connection as connections
+import Metrics as metrics
+import main
+
+# Protobuf structure GPS
+import proto_storage_pb2
+
+
+# Throughput benchmark of the threads and pipeline engines without the production databases.
+# MySQL, Oracle, Redis, PostgreSQL and OSM are replaced by in-process stand-ins with the given latency,
+# TimezoneServer is replaced by a local HTTP server. Everything else is the code of the script.
+
+
+# DB-API cursor of a stand-in, execute() asks the stand-in for the rows
+class StandInCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 1
+        self.prefetchrows = 1
+        self.rowcount = -1
+        self.description = []
+        self._rows = []
+        # Rows of the multi-row INSERT formatted by psycopg2.extras.execute_values
+        self._values = []
+
+    def execute(self, query, parameters=(), **named):
+        if isinstance(query, bytes):
+            query = query.decode("utf-8")
+        self._rows, self.rowcount = self.connection.execute(query, named or parameters, self._values)
+        self._values = []
+
+    def mogrify(self, template, args):
+        self._values.append(args)
+        return b"()"
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchmany(self, size):
+        rows = self._rows[:size]
+        self._rows = self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Connection of a stand-in of one backend, the subclasses answer the queries
+class StandIn(ABC):
+    # Attributes of psycopg2 connections used by ConnectionPostgresql.execute_transaction and execute_values
+    encoding = "UTF8"
+    closed = False
+    autocommit = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Statements prepared by ConnectionOSM.fetch_prepared
+        self.prepared = set()
+
+    def cursor(self, **options):
+        return StandInCursor(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    # Returns (rows, rowcount)
+    @abstractmethod
+    def execute(self, query, parameters, values):
+        pass
+
+
+# Pool of one stand-in shared by all threads, every query waits for the latency of the backend
+class StandInPool:
+    def __init__(self, connection, latency):
+        self._connection = connection
+        self._latency = latency
+
+    def run(self, func, *args, **kwargs):
+        time.sleep(self._latency)
+        return func(self._connection, *args, **kwargs)
+
+    # Connection of ConnectionMysql.stream_data
+    def acquire(self):
+        return self._connection
+
+    def release(self, connection, broken=False):
+        pass
+
+
+# Device list in an in-memory SQLite database, queries are the queries of ConnectionMysql
+class MysqlStandIn(StandIn):
+    def __init__(self, devices):
+        super().__init__()
+        self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        self._db.create_function("MOD", 2, lambda a, b: a % b)
+        self._db.execute("CREATE TABLE devices (device_id INTEGER PRIMARY KEY)")
+        self._db.executemany("INSERT INTO devices VALUES (?)", [(device,) for device in devices])
+
+    def execute(self, query, parameters, values):
+        if query.startswith("SET SESSION"):
+            return [], 0
+        # Statistics of the table, the same as TABLE_ROWS of InnoDB
+        if "information_schema.TABLES" in query:
+            query = "SELECT count(*) FROM devices"
+            parameters = ()
+        with self._lock:
+            rows = self._db.execute(query.replace("%s", "?"), parameters).fetchall()
+        return rows, len(rows)
+
+
+# First locations of devices, only the bulk query of ConnectionOracle is supported
+class OracleStandIn(StandIn):
+    def __init__(self, locations):
+        super().__init__()
+        # {device_id: (lng, lat, speed, ts)}
+        self._locations = locations
+
+    # Device ids are bound as SYS.ODCINUMBERLIST
+    def gettype(self, name):
+        return self
+
+    def newobject(self, values):
+        return list(values)
+
+    def execute(self, query, parameters, values):
+        rows = [(device,) + self._locations[device][:3] + (datetime.fromtimestamp(self._locations[device][3]),)
+                for device in parameters["devs"] if device in self._locations]
+        return rows, len(rows)
+
+
+# geo_summary and its table of last locations
+class PostgresqlStandIn(StandIn):
+    def __init__(self, latest):
+        super().__init__()
+        # {device_id: (device_id, lng, lat, last_location_time)}
+        self._latest = latest
+
+    def execute(self, query, parameters, values):
+        if query.startswith("SELECT"):
+            with self._lock:
+                rows = [self._latest[device] for device in parameters[0] if device in self._latest]
+            return rows, len(rows)
+        values = values or [parameters]
+        if "ON CONFLICT (device_id)" in query:
+            with self._lock:
+                for value in values:
+                    self._latest[value[0]] = (value[0], value[1], value[2], int(value[5]))
+        return [], len(values)
+
+
+# Every point is inside a building with a full address
+class OsmStandIn(StandIn):
+    def execute(self, query, parameters, values):
+        if query.startswith("PREPARE"):
+            return [], 0
+        empty_layers = (None,) * sum(len(columns) for columns, name in connections.ConnectionOSM.bulk_layers[1:])
+        rows = [(i, "{:06d}".format(i % 1000000), "City", "Street {}".format(int(lng * 100) % 100),
+                 str(int(lat * 100) % 100 + 1)) + empty_layers for i, lng, lat in zip(*parameters)]
+        return rows, len(rows)
+
+
+# Current locations of devices as protobuf blobs, like the keys device:{id}:info of Redis
+class RedisStandIn:
+    def __init__(self, locations, latency):
+        self._latency = latency
+        self._data = {}
+        for device, (lng, lat, speed, ts) in locations.items():
+            data = proto_storage_pb2.Data()
+            data.info.device_id = device
+            data.info.type = 0
+            data.position.x = lng
+            data.position.y = lat
+            data.position.s = speed
+            data.position.ts = ts
+            self._data["device:" + str(device) + ":info"] = base64.b64encode(data.SerializeToString())
+
+    def get(self, name):
+        time.sleep(self._latency)
+        return self._data.get(name)
+
+    def mget(self, names):
+        time.sleep(self._latency)
+        return [self._data.get(name) for name in names]
+
+
+# TimezoneServer answers with the same shift after the latency
+def start_tz_server(latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are sent separately, Nagle's algorithm would delay the body until the client's ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            body = json.dumps({"shift": 10800}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class BenchMysql(connections.ConnectionMysql):
+    stand_in = None
+
+    def create_connection(self):
+        self._pool = self.stand_in
+        return 0
+
+
+class BenchOracle(connections.ConnectionOracle):
+    stand_in = None
+
+    def create_connection(self):
+        self._pool = self.stand_in
+        return 0
+
+
+class BenchPostgresql(connections.ConnectionPostgresql):
+    stand_in = None
+
+    def create_connection(self):
+        self._pool = self.stand_in
+        return 0
+
+
+class BenchOSM(connections.ConnectionOSM):
+    stand_in = None
+
+    def create_connection(self):
+        self._pool = self.stand_in
+        return 0
+
+
+class BenchRedis(connections.ConnectionRedis):
+    stand_in = None
+
+    def create_connection(self):
+        self._connection = self.stand_in
+        return 0
+
+
+# Generate devices and their locations, replace the Connection classes with the ones of the stand-ins
+# Returns the configuration of the script
+def create_backends(args, tz_port):
+    rnd = random.Random(args.seed)
+    devices = sorted(rnd.sample(range(1, args.devices * 3 + 1), args.devices))
+    now = int(time.time())
+    locations = {}
+    first_locations = {}
+    latest = {}
+    for device in devices:
+        lng, lat = round(rnd.uniform(30, 60), 6), round(rnd.uniform(40, 60), 6)
+        locations[device] = (lng, lat, rnd.randint(0, 120), now - rnd.randint(60, 86400))
+        first_locations[device] = (lng, lat, 0, now - rnd.randint(86400, 365 * 86400))
+        # Devices which haven't moved since the last check
+        if rnd.random() >= args.moved:
+            latest[device] = (device, lng, lat, locations[device][3])
+        else:
+            latest[device] = (device, lng + 0.01, lat, locations[device][3] - 3600)
+
+    latency = args.latency / 1000
+    BenchMysql.stand_in = StandInPool(MysqlStandIn(devices), latency)
+    BenchOracle.stand_in = StandInPool(OracleStandIn(first_locations), latency)
+    BenchPostgresql.stand_in = StandInPool(PostgresqlStandIn(latest), latency)
+    BenchOSM.stand_in = StandInPool(OsmStandIn(), args.osm_latency / 1000)
+    BenchRedis.stand_in = RedisStandIn(locations, latency)
+    connections.ConnectionMysql = BenchMysql
+    connections.ConnectionOracle = BenchOracle
+    connections.ConnectionPostgresql = BenchPostgresql
+    connections.ConnectionOSM = BenchOSM
+    connections.ConnectionRedis = BenchRedis
+
+    database = dict(host="stand-in", port=0, user="bench", password="bench", database="bench", table="devices")
+    cache_size = {} if args.cache else {"cache_size": 0}
+    return {
+        "PostgreSQL": dict(database, batch_size=args.batch_size),
+        "MySQL": dict(database, chunk=args.chunk),
+        "Oracle": dict(database),
+        "OSM": dict(database, **cache_size),
+        "Redis": {"host": "stand-in", "port": 0},
+        "TimeZoneServer": dict({"host": "127.0.0.1", "port": tz_port}, **cache_size),
+        "Checkpoint": {"file": os.path.join(args.tmp_dir, "checkpoint.json")}
+    }
+
+
+def print_report(elapsed, devices_cnt, result, first):
+    print("Processed {} devices in {:.3f} s: {:.1f} devices/sec.".format(devices_cnt, elapsed,
+                                                                         devices_cnt / elapsed if elapsed else 0))
+    errors_cnt, inserted_rows_cnt, unchanged_loc_cnt = result['finish'][:3]
+    if first:
+        print("Inserted {} rows. {} errors occurred.".format(inserted_rows_cnt, errors_cnt))
+    else:
+        print("Inserted {} rows. {} devices haven't changed their location. "
+              "{} errors occurred.".format(inserted_rows_cnt, unchanged_loc_cnt, errors_cnt))
+    print("{:<32}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}".format("call", "count", "errors", "p50 ms", "p95 ms", "p99 ms",
+                                                           "max ms"))
+    for name, values in metrics.report(metrics.merge([result['metrics']])).items():
+        print("{:<32}{:>9}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+            name, values['count'], values['errors'], values['p50'] * 1000, values['p95'] * 1000,
+            values['p99'] * 1000, values['max'] * 1000))
+    for name, cnt in metrics.merge_counters([result.get('counters', {})]).items():
+        print("{:<32}{:>9}".format(name, cnt))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--devices', default=10000, type=int, help="number of generated devices")
+    parser.add_argument('-f', '--first', action='store_true', help="benchmark the run with the key -f of main.py")
+    parser.add_argument('-e', '--engine', default="threads", choices=["threads", "pipeline"], help="engine of main.py")
+    parser.add_argument('-t', '--threads', default=None, type=int, metavar="number",
+                        help="worker threads of the threads engine")
+    parser.add_argument('--autotune', action='store_true', help="tune the number of worker threads")
+    parser.add_argument('--stream', action='store_true', help="stream devices from MySQL with one query")
+    parser.add_argument('-l', '--latency', default=1.0, type=float, metavar="ms",
+                        help="latency of MySQL, Oracle, Redis, PostgreSQL and TimezoneServer")
+    parser.add_argument('--osm-latency', default=5.0, type=float, metavar="ms", help="latency of OSM")
+    parser.add_argument('-m', '--moved', default=1.0, type=float, metavar="share",
+                        help="share of devices which have changed their location since the last check")
+    parser.add_argument('--chunk', default=1000, type=int, help="MySQL.chunk")
+    parser.add_argument('--batch-size', default=1000, type=int, help="PostgreSQL.batch_size")
+    parser.add_argument('--cache', action='store_true', help="enable geocode and timezone caches")
+    parser.add_argument('--seed', default=1, type=int, help="seed of generated devices")
+    parser.add_argument('-o', '--output', default=None, type=str, metavar="path",
+                        help="save devices/sec and latency of calls as JSON")
+    args = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(filename='geo_summary_benchmark.log', filemode='w', format='[%(levelname)s]   %(message)s')
+    logger = logging.getLogger("geo_sum_benchmark")
+    logger.setLevel('INFO')
+    # Functions of the threads engine log with the logger of main
+    main.logger = logger
+
+    tz_server = start_tz_server(args.latency / 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args.tmp_dir = tmp_dir
+        config_file = os.path.join(tmp_dir, "config.yaml")
+        with open(config_file, 'w') as stream:
+            yaml.safe_dump(create_backends(args, tz_server.server_address[1]), stream)
+        namespace = argparse.Namespace(c=config_file, first=args.first, resume=False, incremental=False,
+                                       engine=args.engine, threads=args.threads, autotune=args.autotune,
+                                       stream=args.stream)
+        start_time = time.time()
+        result = main.run_shard(namespace, None, lambda message: None)
+        elapsed = time.time() - start_time
+    tz_server.shutdown()
+
+    if 'error' in result:
+        print(result['message'].replace("geo_summary_error.log", "geo_summary_benchmark.log"))
+        sys.exit(result['error'])
+    print_report(elapsed, args.devices, result, args.first)
+    if args.output is not None:
+        with open(args.output, 'w') as stream:
+            json.dump({'devices_per_sec': args.devices / elapsed if elapsed else 0, 'runtime': elapsed,
+                       'calls': metrics.report(metrics.merge([result['metrics']])),
+                       'counters': metrics.merge_counters([result.get('counters', {})])}, stream, indent=1)
@@ -0,0 +1,95 @@
+import sys
+import json
+import time
+import random
+import argparse
+
+import psycopg2
+
+import Connection as connections
+import Metrics as metrics
+import Pool as pools
+
+
+# Compare the bulk query of ConnectionOSM.select_data_bulk formatted with the coordinates of a chunk of points, as
+# it is parsed and planned for every chunk, with the prepared statement which is planned once per session.
+# Needs the OSM database of the configuration file.
+
+
+# Bulk query with the arrays of the chunk written into the text
+def format_query(parameters):
+    return connections.ConnectionOSM.bulk_query.format(
+        *["ARRAY[{}]".format(", ".join(repr(value) for value in values)) for values in parameters])
+
+
+# Returns (histogram of the query time, histogram of the planning time)
+def run_bulk(connection, chunks, prepared):
+    timings = metrics.Histogram()
+    planning = metrics.Histogram()
+    with connection.cursor() as cursor:
+        if prepared:
+            cursor.execute("DEALLOCATE ALL")
+            cursor.execute("PREPARE bench_bulk (int[], float8[], float8[]) AS " +
+                           connections.ConnectionOSM.bulk_query.format("$1", "$2", "$3"))
+        for chunk in chunks:
+            # The same parameters as the ones of select_data_bulk: indexes, longitudes and latitudes of the points
+            parameters = (list(range(len(chunk))), [point[0] for point in chunk], [point[1] for point in chunk])
+            if prepared:
+                query = "EXECUTE bench_bulk (%s, %s, %s)"
+            else:
+                query = format_query(parameters)
+                parameters = None
+            start_time = time.perf_counter()
+            cursor.execute(query, parameters)
+            cursor.fetchall()
+            timings.observe(time.perf_counter() - start_time)
+            # Planning time reported by the server for the same query
+            cursor.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + query, parameters)
+            plan = cursor.fetchall()[0][0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            planning.observe(plan[0].get("Planning Time", 0) / 1000)
+        if prepared:
+            cursor.execute("DEALLOCATE ALL")
+    return timings, planning
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', default="config.yaml", type=str, help="path to configuration file", metavar="path")
+    parser.add_argument('-n', '--points', default=2000, type=int, help="number of random points of the region")
+    parser.add_argument('-s', '--chunk', default=100, type=int, help="number of points of one bulk query")
+    parser.add_argument('-r', '--region', default=None, type=float, nargs=4,
+                        metavar=("min_lng", "min_lat", "max_lng", "max_lat"),
+                        help="region of the points, the first region of OSM.index_regions by default")
+    parser.add_argument('--seed', default=1, type=int, help="seed of generated points")
+    namespace = parser.parse_args(sys.argv[1:])
+
+    try:
+        config = pools.read_config(namespace.c)["OSM"]
+        region = namespace.region or [float(value) for value in config["index_regions"][0]]
+        osm_connection = psycopg2.connect(host=config["host"], port=config["port"], user=config["user"],
+                                          password=config["password"], database=config["database"])
+        osm_connection.autocommit = True
+    except Exception as e:
+        print("Failed to connect to OSM. The error occurred: {}".format(e))
+        sys.exit(-10)
+
+    rnd = random.Random(namespace.seed)
+    points = [(rnd.uniform(region[0], region[2]), rnd.uniform(region[1], region[3])) for i in range(namespace.points)]
+    chunks = [points[i:i + namespace.chunk] for i in range(0, len(points), namespace.chunk)]
+
+    print("{:<11}{:>8}{:>10}{:>10}{:>14}{:>14}".format("query", "chunks", "mean ms", "p95 ms", "planning ms",
+                                                       "ms per point"))
+    try:
+        for prepared in (False, True):
+            timings, planning = run_bulk(osm_connection, chunks, prepared)
+            print("{:<11}{:>8}{:>10.3f}{:>10.3f}{:>14.3f}{:>14.3f}".format(
+                "prepared" if prepared else "formatted", timings.count, timings.sum / timings.count * 1000,
+                timings.percentile(0.95) * 1000, planning.sum / planning.count * 1000,
+                timings.sum / len(points) * 1000))
+    except Exception as e:
+        print("Failed to select data from OSM. The error occurred: {}".format(e))
+        sys.exit(-11)
+    finally:
+        osm_connection.close()
@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import logging
+import time
+
+import psycopg2
+
+import Pool as pools
+import AddressIndex as address_indexes
+
+
+# Extract buildings, cities, roads and water of the regions from the OSM tables into the local address index
+# regions = [[min_lng, min_lat, max_lng, max_lat], ...]
+# Returns the number of indexed features
+def build_index(connection, file, regions, fetch_size):
+    tmp_file = file + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    db = sqlite3.connect(tmp_file)
+    db.executescript(address_indexes.SCHEMA)
+    db.executemany("INSERT INTO regions VALUES (?, ?, ?, ?)", [tuple(region) for region in regions])
+    features_cnt = 0
+    for layer, (name, table, columns, keys, condition, distance) in enumerate(address_indexes.LAYERS):
+        # The features near the borders of the regions are found by ST_DWithin of the points inside the regions
+        query = "SELECT {}, ST_AsBinary(geometry), ST_XMin(geometry), ST_XMax(geometry), ST_YMin(geometry), " \
+                "ST_YMax(geometry) FROM {} WHERE {} AND geometry && ST_Expand(ST_Transform(" \
+                "ST_MakeEnvelope(%s, %s, %s, %s, 4326), 3857), %s);".format(columns, table, condition)
+        margin = distance or 0
+        # A feature may be in several regions
+        indexed = set()
+        for region in regions:
+            # Server-side cursor, the features are fetched by parts
+            with connection.cursor(name="address_index") as cursor:
+                cursor.itersize = fetch_size
+                cursor.execute(query, tuple(region) + (margin,))
+                for row in cursor:
+                    geometry = bytes(row[len(keys)])
+                    if geometry in indexed:
+                        continue
+                    indexed.add(geometry)
+                    features_cnt += 1
+                    db.execute("INSERT INTO features VALUES (?, ?, ?, ?)",
+                               (features_cnt, layer, json.dumps(dict(zip(keys, row[:len(keys)])), sort_keys=True),
+                                geometry))
+                    min_x, max_x, min_y, max_y = row[len(keys) + 1:]
+                    db.execute("INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)",
+                               (features_cnt, min_x - margin, max_x + margin, min_y - margin, max_y + margin))
+            connection.commit()
+        logger.info("Layer {}: {} features.".format(name, len(indexed)))
+    db.commit()
+    db.close()
+    # The old index is replaced at once, running scripts keep reading the old file
+    os.replace(tmp_file, file)
+    return features_cnt
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', default="config.yaml", type=str, help="path to configuration file", metavar="path")
+    parser.add_argument('--fetch-size', default=10000, type=int, metavar="rows",
+                        help="features fetched from PostGIS at once")
+    namespace = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(filename='geo_summary_index.log', filemode='w', format='[%(levelname)s]   %(message)s')
+    logger = logging.getLogger("geo_sum_index")
+    logger.setLevel('INFO')
+
+    try:
+        config = pools.read_config(namespace.c)["OSM"]
+        index_file = config["index_file"]
+        index_regions = [[float(value) for value in region] for region in config["index_regions"]]
+        if any(len(region) != 4 for region in index_regions):
+            raise Exception("'index_regions' must be lists of min_lng, min_lat, max_lng, max_lat")
+    except Exception as e:
+        logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+        print("Failed to read configuration file. The error occurred: {}".format(e))
+        sys.exit(-10)
+
+    try:
+        osm_connection = psycopg2.connect(host=config["host"], port=config["port"], user=config["user"],
+                                          password=config["password"], database=config["database"])
+    except Exception as e:
+        logger.critical("Failed to connect to OSM. The error occurred: {}.".format(e))
+        print("Failed to connect to database. Details are in geo_summary_index.log.")
+        sys.exit(-10)
+
+    try:
+        cnt = build_index(osm_connection, index_file, index_regions, namespace.fetch_size)
+    except Exception as e:
+        logger.critical("Failed to build address index. The error occurred: {}.".format(e))
+        print("Failed to select data from database. Details are in geo_summary_index.log.")
+        sys.exit(-11)
+    finally:
+        osm_connection.close()
+
+    ans_str = "Indexed {} features of {} regions in {}.".format(cnt, len(index_regions), index_file)
+    logger.info(ans_str)
+    print(ans_str)
+    time_str = "Runtime of the program is {:.3f} hours.".format((time.time() - start_time) / 3600)
+    logger.info(time_str)
+    print(time_str)
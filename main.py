@@ -1,15 +1,27 @@
+import os
+import glob
 import sys
+import json
 import argparse
 import logging
 import time
 from threading import Thread
 import queue
+import multiprocessing
 
 import Connection as connections
+import Cache as caches
+import Processing as processing
+import Scheduler as scheduler
+import Checkpoint as checkpoints
+import Pool as pools
+import Metrics as metrics
 
 
 # Connect to databases and TimeZoneServer
-def init_connections(config, logger, isFirst):
+def init_connections(config, logger, isFirst, cache=None):
+    if cache is None:
+        cache = {'osm': None, 'tz': None}
     con = {}
     error = 0
     try:
@@ -32,11 +44,11 @@ def init_connections(config, logger, isFirst):
         error = con['psql'].create_connection()
         if error:
             return {'error': error}
-        con['osm'] = connections.ConnectionOSM(config, logger)
+        con['osm'] = connections.ConnectionOSM(config, logger, cache['osm'])
         error = con['osm'].create_connection()
         if error:
             return {'error': error}
-        con['tz'] = connections.ConnectionTimeZoneServer(config, logger)
+        con['tz'] = connections.ConnectionTimeZoneServer(config, logger, cache['tz'])
         error = con['tz'].create_connection()
         if error:
             return {'error': error}
@@ -46,145 +58,513 @@ def init_connections(config, logger, isFirst):
         return {'error': -10}
 
 
-# Print processing progress
-def print_progress(progress, total):
-    percent = "{:.2f}".format((progress / float(total)) * 100)
-    print("Progress: {}% complete".format(percent), end="\r")
+# Create geocode and timezone caches shared by all threads
+def init_caches(config, logger, shard=None):
+    cache = {'osm': None, 'tz': None}
+    try:
+        config_data = pools.read_config(config)
+        size = int(config_data["OSM"].get("cache_size", 100000))
+        if size > 0:
+            cache_file = config_data["OSM"].get("cache_file")
+            cache['osm'] = caches.GeocodeCache(size, float(config_data["OSM"].get("cache_cell", 0.0001)),
+                                               check_shard_file(cache_file, shard, logger) if cache_file else None)
+            cache['osm'].load()
+        size = int(config_data["TimeZoneServer"].get("cache_size", 100000))
+        if size > 0:
+            cache['tz'] = caches.TimeZoneCache(size, float(config_data["TimeZoneServer"].get("cache_cell", 0.01)),
+                                               int(config_data["TimeZoneServer"].get("cache_max_gap", 7 * 86400)))
+    except Exception as e:
+        logger.error("Failed to create caches. The error occurred: {}.".format(e))
+    return cache
+
+
+# Create the checkpoint of processed devices shared by all threads, load it if the run is resumed
+def init_checkpoint(config, logger, isFirst, resume, shard=None):
+    try:
+        config_data = pools.read_config(config).get("Checkpoint") or {}
+        path = config_data.get("file", "geo_summary_checkpoint.json")
+        path = check_shard_file(path, shard, logger) if resume else shard_file(path, shard)
+        checkpoint = checkpoints.Checkpoint(path, isFirst, float(config_data.get("interval", 10)))
+        if resume:
+            checkpoint.load()
+            logger.info("Resume the run, {} devices have already been processed.".format(checkpoint.devices_cnt))
+        return checkpoint
+    except Exception as e:
+        logger.error("Failed to create checkpoint. The error occurred: {}.".format(e))
+        return None
+
+
+# Settings of the incremental mode, 'since' is the time of the last successful run minus the overlap
+def init_incremental(config, logger, shard=None):
+    try:
+        config_data = pools.read_config(config).get("Incremental") or {}
+        incremental = {
+            'updates_key': config_data.get("updates_key"),
+            'state_file': check_shard_file(config_data.get("state_file", "geo_summary_incremental.json"), shard,
+                                           logger),
+            'scan_count': int(config_data.get("scan_count", 1000)),
+            'since': 0,
+            'failed_devices': []
+        }
+        if os.path.exists(incremental['state_file']):
+            with open(incremental['state_file'], 'r') as stream:
+                state = json.load(stream)
+            incremental['since'] = state["last_run_start"] - float(config_data.get("overlap", 300))
+            incremental['failed_devices'] = state.get("failed_devices", [])
+        return incremental
+    except Exception as e:
+        logger.critical("Failed to read settings of incremental mode. The error occurred: {}.".format(e))
+        return None
+
+
+# Save the start time of the finished run, the next incremental run selects devices updated after it and the devices
+# which have failed in this run
+def save_incremental(incremental, run_start_time, failed_devices):
+    tmp_file = incremental['state_file'] + ".tmp"
+    with open(tmp_file, 'w') as stream:
+        json.dump({"last_run_start": run_start_time, "failed_devices": failed_devices}, stream)
+    os.replace(tmp_file, incremental['state_file'])
+
+
+# Save latency histograms and counters of all processes as a JSON report and, optionally, as a Prometheus textfile
+def save_metrics(config, logger, snapshots, runtime, counter_snapshots=()):
+    try:
+        config_data = pools.read_config(config).get("Metrics") or {}
+        histograms = metrics.merge(snapshots)
+        counts = metrics.merge_counters(counter_snapshots)
+        metrics.save_report(config_data.get("report_file", "geo_summary_metrics.json"), histograms, runtime, counts)
+        if config_data.get("textfile"):
+            metrics.save_textfile(config_data["textfile"], histograms, runtime, counts)
+    except Exception as e:
+        logger.error("Failed to save metrics. The error occurred: {}.".format(e))
+
+
+# Print processing progress, rate is the number of devices processed per second
+def print_progress(progress, total, rate=None):
+    # The number of devices may change during the run
+    percent = "{:.2f}".format(min(progress / float(total), 1) * 100 if total else 100)
+    if not rate:
+        print("Progress: {}% complete".format(percent), end="\r")
+        return
+    eta = int(max(total - progress, 0) / rate)
+    print("Progress: {}% complete, {:.1f} devices/sec, ETA {:d}:{:02d}:{:02d}   ".format(
+        percent, rate, eta // 3600, eta // 60 % 60, eta % 60), end="\r")
+
+
+# Define timezones and addresses of devices' locations, add new rows to the geo_summary insert buffer
+# locations = [(device_id, lng, lat, speed, ts), ...]
+def insert_locations(con, locations):
+    rows, errors_cnt = processing.define_timezones(con, locations)
+    rows, errors = processing.define_addresses(con, rows)
+    errors_cnt += errors
+    inserted_rows_cnt, errors = processing.add_rows(con, rows)
+    errors_cnt += errors
+    return inserted_rows_cnt, errors_cnt
 
 
 # Insert first location of each device in geo_summary
-def insert_first_dev_locations(que, con, rows_range):
-    offset = rows_range[0]
-    chunk = 10
+# devices_chunks = iterable of (error, devices, chunk_range) of the work queue
+def insert_first_dev_locations(que, con, devices_chunks, checkpoint=None):
     errors_cnt = 0
     inserted_rows_cnt = 0
     max_time = 0
-    while 1:
-        # Select list of 10-19 devices
-        if (offset + 2 * chunk) >= rows_range[1]:
-            chunk = rows_range[1] - offset
-        error = con['mysql'].select_data(offset, chunk)
+    pending = processing.PendingRanges(checkpoint)
+    for error, devices, chunk_range in devices_chunks:
         if error:
             que.put({'error': error})
             return
 
-        for device in con['mysql'].selected_data:
-            # Select data of the first location for each device
-            # con['oracle'].selected_data = [lng, lat, speed, time]
-            if con['oracle'].select_data(device):
-                errors_cnt += 1
-                continue
-            if con['oracle'].selected_data[3] > time.time():
-                logger.error("Device: {}. Incorrect timestamp.".format(device))
-                errors_cnt += 1
-                continue
-
-            # Define device's timezone
-            # args = (lng, lat, ts_utc)
-            if con['tz'].select_data(con['oracle'].selected_data[0], con['oracle'].selected_data[1],
-                                     con['oracle'].selected_data[3]):
-                errors_cnt += 1
-                continue
-
-            # Define device's address
-            # args = (lng, lat)
-            if con['osm'].select_data(con['oracle'].selected_data[0], con['oracle'].selected_data[1]):
-                errors_cnt += 1
-                continue
-
-            # Insert new row into geo_summary
-            # args = (device_id, lng, lat, address, speed, last_location_time, timezone_shift)
-            start_time = time.time()
-            if not con['psql'].insert_data((device, con['oracle'].selected_data[0], con['oracle'].selected_data[1],
-                                           con['osm'].selected_data, con['oracle'].selected_data[2],
-                                           con['oracle'].selected_data[3], con['tz'].selected_data)):
-                inserted_rows_cnt += 1
-            else:
-                errors_cnt += 1
-            cur_time = time.time() - start_time
-            if cur_time > max_time:
-                max_time = cur_time
+        start_time = time.time()
+        # Select data of the first location for the whole chunk of devices
+        locations, errors = processing.select_first_locations(con, devices, logger)
+        errors_cnt += errors
+
+        inserted, errors = insert_locations(con, locations)
+        inserted_rows_cnt += inserted
+        errors_cnt += errors
+        pending.add(chunk_range, len(devices))
+        pending.commit(con)
+        cur_time = time.time() - start_time
+        metrics.observe("chunk", cur_time)
+        if cur_time > max_time:
+            max_time = cur_time
+
         # Print current progress
-        que.put({'progress': chunk})
-        offset += chunk
-        if offset == rows_range[1]:
-            break
-    logger.info("Max processing time of one device: {}".format(max_time))
-    que.put({'finish': (errors_cnt, inserted_rows_cnt, 0)})
+        que.put({'progress': len(devices)})
+    # Insert the rest of buffered rows
+    inserted, errors = con['psql'].flush_data()
+    inserted_rows_cnt += inserted
+    errors_cnt += errors
+    pending.commit(con)
+    logger.info("Max processing time of one chunk of devices: {}".format(max_time))
+    que.put({'finish': (errors_cnt, inserted_rows_cnt, 0, max_time)})
 
 
 # Check last location of each device
-def insert_last_dev_locations(que, con, rows_range):
-    offset = rows_range[0]
-    chunk = 10
+# devices_chunks = iterable of (error, devices, chunk_range) of the work queue
+def insert_last_dev_locations(que, con, devices_chunks, checkpoint=None):
     errors_cnt = 0
     inserted_rows_cnt = 0
     unchanged_loc_cnt = 0
     max_time = 0
-
-    while 1:
-        # Select list of 10-19 devices
-        if (offset + 2 * chunk) >= rows_range[1]:
-            chunk = rows_range[1] - offset
-        error = con['mysql'].select_data(offset, chunk)
+    pending = processing.PendingRanges(checkpoint)
+    for error, devices, chunk_range in devices_chunks:
         if error:
             que.put({'error': error})
             return
 
-        # Select last locations of devices from geo_summary
-        error = con['psql'].select_data(con['mysql'].selected_data)
-
-        for device in con['mysql'].selected_data:
-            start_time = time.time()
-            # con['redis'].selected_data = [device_id, lng, lat, speed, time]
-            if con['redis'].select_data(device):
-                errors_cnt += 1
-                continue
-            if con['redis'].selected_data[4] > time.time():
-                logger.error("Device: {}. Incorrect timestamp.".format(device))
-                errors_cnt += 1
-                continue
-
-            # Check if the device's location changed
-            if (not error) and (device in con['psql'].selected_data):
-                if ((con['redis'].selected_data[1] == con['psql'].selected_data[device][1])
-                        and (con['redis'].selected_data[2] == con['psql'].selected_data[device][2]))\
-                        or (con['redis'].selected_data[4] <= con['psql'].selected_data[device][3]):
-                    unchanged_loc_cnt += 1
-                    continue
-
-            # Define device's timezone
-            # args = (lng, lat, ts_utc)
-            if con['tz'].select_data(con['redis'].selected_data[1], con['redis'].selected_data[2],
-                                     con['redis'].selected_data[4]):
-                errors_cnt += 1
-                continue
-
-            # Define device's address
-            # args = (lng, lat)
-            if con['osm'].select_data(con['redis'].selected_data[1], con['redis'].selected_data[2]):
-                errors_cnt += 1
-                continue
-
-            # Insert new row into geo_summary
-            # [device_id, lng, lat, address, speed, last_location_time, timezone_shift]
-            if not con['psql'].insert_data((device, con['redis'].selected_data[1], con['redis'].selected_data[2],
-                                            con['osm'].selected_data, con['redis'].selected_data[3],
-                                            con['redis'].selected_data[4], con['tz'].selected_data)):
-                inserted_rows_cnt += 1
-            else:
-                errors_cnt += 1
-            cur_time = time.time() - start_time
-            if cur_time > max_time:
-                max_time = cur_time
+        start_time = time.time()
+        # Select current locations of the whole chunk of devices
+        locations, errors = processing.select_last_locations(con, devices, logger)
+        errors_cnt += errors
+
+        # Check if the devices' locations changed
+        locations, unchanged = processing.select_changed_locations(con, locations)
+        unchanged_loc_cnt += unchanged
+
+        inserted, errors = insert_locations(con, locations)
+        inserted_rows_cnt += inserted
+        errors_cnt += errors
+        pending.add(chunk_range, len(devices))
+        pending.commit(con)
+        cur_time = time.time() - start_time
+        metrics.observe("chunk", cur_time)
+        if cur_time > max_time:
+            max_time = cur_time
 
         # Print current progress
-        que.put({'progress': chunk})
-        offset += chunk
-        if offset == rows_range[1]:
+        que.put({'progress': len(devices)})
+    # Insert the rest of buffered rows
+    inserted, errors = con['psql'].flush_data()
+    inserted_rows_cnt += inserted
+    errors_cnt += errors
+    pending.commit(con)
+    logger.info("Max processing time of one chunk of devices: {}".format(max_time))
+    que.put({'finish': (errors_cnt, inserted_rows_cnt, unchanged_loc_cnt, max_time)})
+
+
+# Stream all devices of the shard from MySQL into the work queue of the worker threads
+def stream_devices(que, con, work, checkpoint=None):
+    # Device ids are BIGINT, the parts processed by the interrupted run are skipped
+    devices_range = (-2 ** 63, 2 ** 63 - 1)
+    ranges = [devices_range] if checkpoint is None else checkpoint.remaining(devices_range)
+    # The workers wait for the end mark, so it is put after the error too
+    try:
+        for error, devices, chunk_range in con['mysql'].stream_data(ranges):
+            if error:
+                que.put({'error': error})
+                return
+            work.put(devices, chunk_range)
+        con['mysql'].close_connection()
+    finally:
+        work.finish()
+
+
+# Parse the shard "index/count", the shard contains devices with device_id % count = index - 1
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid shard: '{}', expected 'index/count'".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("invalid shard: '{}', index must be from 1 to count".format(value))
+    return index, count
+
+
+# Shards of the local processes. Devices of the shard index/count are split again by (device_id // count) % processes,
+# so the shards of several hosts don't overlap, whatever number of processes each host runs.
+def split_shard(shard, processes):
+    index, count = shard if shard is not None else (1, 1)
+    return [(index + count * i, count * processes) for i in range(processes)]
+
+
+# Every shard has its own checkpoint, incremental mode and geocode cache files
+def shard_file(path, shard):
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}.{}-{}{}".format(root, shard[0], shard[1], ext)
+
+
+# The shards of the local processes depend on -p, so after -s or -p has changed the files of the previous runs are
+# not found and the run starts from scratch, the warning is logged if the files of other shards exist
+def check_shard_file(path, shard, logger):
+    own_file = shard_file(path, shard)
+    if os.path.exists(own_file):
+        return own_file
+    root, ext = os.path.splitext(path)
+    other_files = glob.glob(glob.escape(root) + ".*-*" + glob.escape(ext))
+    if os.path.exists(path):
+        other_files.append(path)
+    if other_files:
+        logger.warning("File {} doesn't exist, but the files of other shards do: {}. The shard or the number of "
+                       "processes has changed since the previous run, the files are not used.".format(
+                           own_file, ", ".join(sorted(other_files))))
+    return own_file
+
+
+# Messages about critical errors
+config_error_str = "Failed to read configuration file. Details are in geo_summary_error.log."
+connect_error_str = "Failed to connect to database. Details are in geo_summary_error.log."
+select_error_str = "Failed to select data from database. Details are in geo_summary_error.log."
+
+
+# Settings of the threads engine, the number of workers of the key -t overrides the configuration file
+def init_threads_settings(config, namespace):
+    settings = pools.read_config(config).get("Threads") or {}
+    workers = namespace.threads or int(settings.get("workers", 15))
+    autotune = namespace.autotune or bool(settings.get("autotune", False))
+    threads = {
+        'workers': workers,
+        'autotune': autotune,
+        'min_workers': min(int(settings.get("min_workers", 1)), workers) if autotune else workers,
+        'max_workers': max(int(settings.get("max_workers", 32)), workers) if autotune else workers,
+        'ranges': int(settings.get("ranges", 16)),
+        'interval': float(settings.get("autotune_interval", 10)),
+        'latency_limit': float(settings.get("latency_limit", 2))
+    }
+    if (workers < 1) or (threads['min_workers'] < 1) or (threads['ranges'] < 1):
+        raise Exception("'workers', 'min_workers' and 'ranges' of the section Threads must be positive")
+    return threads
+
+
+# Start a worker of the threads engine, it takes devices from the work queue until the queue is empty
+# Returns (error, thread)
+def start_worker(namespace, que, work, cache, checkpoint, updated_devices, failed=None):
+    con = init_connections(namespace.c, logger, namespace.first, cache)
+    if 'error' in con:
+        return con['error'], None
+    # Processing.FailedDevices of the incremental run
+    con['failed'] = failed
+    devices_chunks = work.chunks(con, checkpoint, updated_devices)
+    target = insert_first_dev_locations if namespace.first else insert_last_dev_locations
+    t = Thread(target=metrics.profiled, args=(target, que, con, devices_chunks, checkpoint), daemon=True)
+    t.start()
+    return 0, t
+
+
+# Process devices of the shard in the worker threads or in the engine, shard = None means all devices
+# report(message) is called with {'total': devices_cnt} and {'progress': processed_devices_cnt}
+# Returns {'finish': (errors_cnt, inserted_rows_cnt, unchanged_loc_cnt, max_time), 'cache': {'osm': (hits, misses),
+# 'tz': (hits, misses)}} or {'error': error, 'message': message}
+def process_shard(namespace, shard, report):
+    run_start_time = time.time()
+    que = queue.Queue()
+    threads_list = list()
+    connections.ConnectionMysql.shard = shard
+
+    cache = init_caches(namespace.c, logger, shard)
+    checkpoint = init_checkpoint(namespace.c, logger, namespace.first, namespace.resume, shard)
+
+    # Select devices whose position has been updated since the last successful run
+    incremental = None
+    updated_devices = None
+    failed = None
+    if namespace.incremental:
+        incremental = init_incremental(namespace.c, logger, shard)
+        if incremental is None:
+            return {'error': -10, 'message': config_error_str}
+        try:
+            con = {'redis': connections.ConnectionRedis(namespace.c, logger)}
+        except Exception as e:
+            logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+            return {'error': -10, 'message': connect_error_str}
+        error = con['redis'].create_connection()
+        if error:
+            return {'error': error, 'message': connect_error_str}
+        error = con['redis'].select_updated_devices(incremental['since'], incremental['updates_key'],
+                                                    incremental['scan_count'])
+        if error:
+            return {'error': error, 'message': select_error_str}
+        updated_devices = [device for device in con['redis'].selected_data
+                           if (shard is None) or (device % shard[1] == shard[0] - 1)]
+        con['redis'].close_connection()
+        logger.info("{} devices have been updated since {}.".format(len(updated_devices), incremental['since']))
+        if incremental['failed_devices']:
+            logger.info("{} devices have failed in the last run.".format(len(incremental['failed_devices'])))
+            updated_devices = sorted(set(updated_devices).union(incremental['failed_devices']))
+        failed = processing.FailedDevices()
+
+    # Split devices into small ranges of device ids, the worker threads take them from the shared work queue
+    try:
+        threads = init_threads_settings(namespace.c, namespace)
+        parts = threads['max_workers'] * threads['ranges'] if namespace.engine == "threads" else 1
+        con = {'mysql': connections.ConnectionMysql(namespace.c, logger)}
+        if namespace.engine == "async":
+            import AsyncEngine as async_engine
+            engine = async_engine.AsyncEngine(namespace.c, logger, namespace.first, cache, checkpoint,
+                                              updated_devices, failed)
+        elif namespace.engine == "pipeline":
+            import Pipeline as pipeline
+            engine = pipeline.Pipeline(namespace.c, logger, namespace.first, cache, checkpoint, updated_devices,
+                                       failed)
+    except Exception as e:
+        logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+        return {'error': -10, 'message': connect_error_str}
+    if updated_devices is not None:
+        rows_number = len(updated_devices)
+        boundaries = processing.split_devices(updated_devices, parts)
+    elif namespace.stream:
+        # Progress is shown against the estimated number of devices, they are not counted
+        error = con['mysql'].create_connection()
+        if error:
+            return {'error': error, 'message': connect_error_str}
+        error = con['mysql'].select_estimate()
+        if error:
+            return {'error': error, 'message': select_error_str}
+        rows_number = con['mysql'].selected_data
+    else:
+        error = con['mysql'].create_connection()
+        if error:
+            return {'error': error, 'message': connect_error_str}
+        # Ranges with the same number of devices, so clustered device ids don't leave most of the devices
+        # to one worker
+        error = con['mysql'].select_boundaries(parts)
+        if error:
+            return {'error': error, 'message': select_error_str}
+        rows_number, boundaries = con['mysql'].selected_data
+        con['mysql'].close_connection()
+
+    tuner = None
+    if namespace.engine != "threads":
+        t = Thread(target=metrics.profiled, args=(engine.run, que, (boundaries[0], boundaries[-1])), daemon=True)
+        t.start()
+        threads_list.append(t)
+    elif namespace.stream:
+        # Two chunks per worker are read ahead
+        work = scheduler.StreamQueue(2 * threads['max_workers'])
+        Thread(target=metrics.profiled, args=(stream_devices, que, con, work, checkpoint), daemon=True).start()
+    else:
+        work = scheduler.WorkQueue([(boundaries[i], boundaries[i + 1]) for i in range(parts)
+                                    if boundaries[i] < boundaries[i + 1]])
+    if namespace.engine == "threads":
+        for i in range(threads['workers']):
+            error, t = start_worker(namespace, que, work, cache, checkpoint, updated_devices, failed)
+            if error:
+                return {'error': error, 'message': connect_error_str}
+            threads_list.append(t)
+        if threads['autotune']:
+            tuner = scheduler.Autotuner(threads['workers'], threads['min_workers'], threads['max_workers'],
+                                        threads['interval'], latency_limit=threads['latency_limit'])
+    max_workers = len(threads_list)
+
+    # Devices processed by the interrupted run
+    report({'total': rows_number, 'progress': checkpoint.devices_cnt if checkpoint is not None else 0})
+    finished = 0
+    processed = 0
+    ans = [0, 0, 0, 0]
+    while finished < len(threads_list):
+        try:
+            result = que.get(timeout=None if tuner is None else 1)
+        except queue.Empty:
+            result = {}
+        if 'finish' in result:
+            ans[0] += result['finish'][0]
+            ans[1] += result['finish'][1]
+            ans[2] += result['finish'][2]
+            ans[3] = max(ans[3], result['finish'][3])
+            finished += 1
+        if 'progress' in result:
+            processed += result['progress']
+            report({'progress': result['progress']})
+        if 'error' in result:
+            ans[0] = result['error']
             break
-    logger.info("Max processing time of one device: {}".format(max_time))
-    que.put({'finish': (errors_cnt, inserted_rows_cnt, unchanged_loc_cnt)})
+        # The number of workers is not changed when the last ranges are processed
+        if (tuner is not None) and len(work):
+            change = tuner.sample(processed)
+            if change > 0:
+                error, t = start_worker(namespace, que, work, cache, checkpoint, updated_devices, failed)
+                if error:
+                    logger.error("Failed to start a new worker thread.")
+                    tuner.workers -= 1
+                else:
+                    threads_list.append(t)
+            elif change < 0:
+                work.retire()
+            if change:
+                logger.info("Worker threads: {}.".format(tuner.workers))
+                max_workers = max(max_workers, tuner.workers)
+    if namespace.engine == "threads":
+        logger.info("Max number of worker threads: {}.".format(max_workers))
+    if checkpoint is not None:
+        try:
+            checkpoint.save(ans[0] >= 0)
+        except Exception as e:
+            logger.error("Failed to save checkpoint. The error occurred: {}.".format(e))
+
+    if ans[0] < 0:
+        return {'error': ans[0], 'message': select_error_str}
+    # Devices which have failed are updated before the next 'since', so they are saved and selected by the next run
+    if incremental is not None:
+        try:
+            save_incremental(incremental, run_start_time, failed.devices())
+        except Exception as e:
+            logger.error("Failed to save the time of the run. The error occurred: {}.".format(e))
+    stats = {}
+    for name in ('osm', 'tz'):
+        if cache[name] is not None:
+            stats[name] = (cache[name].hits, cache[name].misses)
+    if cache['osm'] is not None:
+        try:
+            cache['osm'].save()
+        except Exception as e:
+            logger.error("Failed to save geocode cache. The error occurred: {}.".format(e))
+    return {'finish': tuple(ans), 'cache': stats}
+
+
+# Process devices of the shard and release its resources, the result is given latency histograms of the process
+# Worker loops are profiled with cProfile, if the profile file is set in the configuration file
+def run_shard(namespace, shard, report):
+    profile_file = None
+    try:
+        profile_file = (pools.read_config(namespace.c).get("Metrics") or {}).get("profile")
+    except Exception:
+        pass
+    metrics.profiling = bool(profile_file)
+    result = process_shard(namespace, shard, report)
+    pools.close_pools()
+    result['metrics'] = metrics.snapshot()
+    result['counters'] = metrics.counters()
+    if profile_file:
+        try:
+            metrics.save_profile(shard_file(profile_file, shard))
+        except Exception as e:
+            logger.error("Failed to save profile. The error occurred: {}.".format(e))
+    return result
+
+
+# Target of the local processes, every process has its own connections, caches and threads
+def process_shard_target(namespace, shard, que):
+    try:
+        result = run_shard(namespace, shard, que.put)
+    except Exception as e:
+        logger.critical("Shard {}/{}. Failed to process devices. The error occurred: {}.".format(shard[0], shard[1],
+                                                                                                 e))
+        result = {'error': -11, 'message': select_error_str}
+    que.put(result)
+
+
+# Progress of all shards, the rate is measured from the first reported total
+class Progress:
+    def __init__(self):
+        self.total = 0
+        self.progress = 0
+        # Devices processed by the interrupted run are not counted in the rate
+        self.resumed = 0
+        self.start_time = None
+
+    def report(self, message):
+        if 'total' in message:
+            self.resumed += message.get('progress', 0)
+            if self.start_time is None:
+                self.start_time = time.time()
+        self.total += message.get('total', 0)
+        self.progress += message.get('progress', 0)
+        rate = None
+        if (self.start_time is not None) and (time.time() > self.start_time):
+            rate = (self.progress - self.resumed) / (time.time() - self.start_time)
+        print_progress(self.progress, self.total, rate)
 
 
 if __name__ == '__main__':
@@ -196,85 +576,95 @@ if __name__ == '__main__':
     parser.add_argument('-c', default="config.yaml", type=str, help="path to configuration file", metavar="path")
     parser.add_argument('-f', '--first', action='store_true',
                         help="script defines address of the first location for each device")
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help="skip devices processed by the interrupted run with the same -f key")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="process only devices whose position has been updated since the last successful run")
+    parser.add_argument('-e', '--engine', default="threads", choices=["threads", "async", "pipeline"],
+                        help="process devices in worker threads, in one asyncio event loop or in pipeline stages")
+    parser.add_argument('-t', '--threads', default=None, type=int, metavar="number",
+                        help="worker threads of the threads engine (15 or Threads.workers of the configuration file)")
+    parser.add_argument('--autotune', action='store_true',
+                        help="tune the number of worker threads by the rate of processed devices")
+    parser.add_argument('--stream', action='store_true',
+                        help="read all devices from MySQL by one query with an unbuffered cursor (threads engine)")
+    parser.add_argument('-s', '--shard', default=None, type=parse_shard, metavar="index/count",
+                        help="process only devices with device_id %% count = index - 1, e.g. 1/4 on the first host")
+    parser.add_argument('-p', '--processes', default=1, type=int, metavar="number",
+                        help="split devices between several local processes")
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.first and namespace.incremental:
+        parser.error("argument -i/--incremental: not allowed with argument -f/--first")
+    if namespace.processes < 1:
+        parser.error("argument -p/--processes: must be positive")
+    if namespace.stream and (namespace.incremental or namespace.engine != "threads"):
+        parser.error("argument --stream: allowed only with the threads engine and without -i/--incremental")
+    if (namespace.threads is not None) and (namespace.threads < 1):
+        parser.error("argument -t/--threads: must be positive")
 
     logging.basicConfig(filename='geo_summary_error.log', filemode='w', format='[%(levelname)s]   %(message)s')
     logger = logging.getLogger("geo_sum_main")
     logger.setLevel('INFO')
 
-    rows_number = 0
-    threads_number = 15
-    chunk_size = 0
-    que = queue.Queue()
-    threads_list = list()
-
     if namespace.first:
         print("Insert first devices' locations.")
         logger.info("Insert first devices' locations.")
     else:
         print("Insert last devices' locations.")
         logger.info("Insert last devices' locations.")
+    if namespace.shard is not None:
+        logger.info("Shard {}/{}.".format(*namespace.shard))
     print_progress(0, 100)
+    progress = Progress()
 
-    for i in range(threads_number):
-        con = init_connections(namespace.c, logger, namespace.first)
-
-        if 'error' in con:
-            print("Failed to connect to database. Details are in geo_summary_error.log.")
-            sys.exit(con['error'])
-        if i == 0:
-            error = con['mysql'].select_data()
-            if error:
-                print("Failed to select data from database. Details are in geo_summary_error.log.")
-                sys.exit(error)
-            rows_number = con['mysql'].selected_data
-            chunk_size = rows_number // threads_number
-
-        if namespace.first:
-            if i + 1 < threads_number:
-                t = Thread(target=insert_first_dev_locations,
-                           args=(que, con, (i * chunk_size, (i + 1) * chunk_size)), daemon=True)
-            else:
-                t = Thread(target=insert_first_dev_locations,
-                           args=(que, con, (i * chunk_size, (i + 1) * chunk_size + rows_number % threads_number)),
-                           daemon=True)
-        else:
-            if i + 1 < threads_number:
-                t = Thread(target=insert_last_dev_locations,
-                           args=(que, con, (i * chunk_size, (i + 1) * chunk_size)), daemon=True)
+    if namespace.processes == 1:
+        results = [run_shard(namespace, namespace.shard, progress.report)]
+    else:
+        # Processes are forked, so they share the logger and the parsed arguments
+        context = multiprocessing.get_context("fork")
+        que = context.Queue()
+        processes_list = []
+        for shard in split_shard(namespace.shard, namespace.processes):
+            p = context.Process(target=process_shard_target, args=(namespace, shard, que), daemon=True)
+            p.start()
+            processes_list.append(p)
+        results = []
+        while len(results) < len(processes_list):
+            result = que.get()
+            if ('finish' in result) or ('error' in result):
+                results.append(result)
+                if 'error' in result:
+                    break
             else:
-                t = Thread(target=insert_last_dev_locations,
-                           args=(que, con, (i * chunk_size, (i + 1) * chunk_size + rows_number % threads_number)),
-                           daemon=True)
-        t.start()
-        threads_list.append(t)
-
-    progress = 0
-    ans = [0, 0, 0]
-    while (rows_number != progress) or (ans[0] + ans[1] + ans[2] != progress):
-        result = que.get()
-        if 'finish' in result:
-            ans[0] += result['finish'][0]
-            ans[1] += result['finish'][1]
-            ans[2] += result['finish'][2]
-        if 'progress' in result:
-            progress += result['progress']
-            print_progress(progress, rows_number)
+                progress.report(result)
+        for p in processes_list:
+            if 'error' in results[-1]:
+                p.terminate()
+            p.join()
+
+    save_metrics(namespace.c, logger, [result.get('metrics', {}) for result in results], time.time() - start_time,
+                 [result.get('counters', {}) for result in results])
+    for result in results:
         if 'error' in result:
-            ans[0] = result['error']
-            break
-
-    if ans[0] < 0:
-        print("Failed to select data from database. Details are in geo_summary_error.log.")
-        sys.exit(ans[0])
+            print(result['message'])
+            sys.exit(result['error'])
+    ans = [sum(result['finish'][i] for result in results) for i in range(3)]
+    logger.info("Max processing time of one chunk of devices: {}".format(max(result['finish'][3]
+                                                                             for result in results)))
+    if namespace.first:
+        ans_str = "Inserted {} rows. {} errors occurred.".format(ans[1], ans[0])
     else:
-        if namespace.first:
-            ans_str = "Inserted {} rows. {} errors occurred.".format(ans[1], ans[0])
-        else:
-            ans_str = "Inserted {} rows. {} devices haven't changed their location. " \
-                      "{} errors occurred.".format(ans[1], ans[2], ans[0])
-        logger.info(ans_str)
-        print(ans_str)
+        ans_str = "Inserted {} rows. {} devices haven't changed their location. " \
+                  "{} errors occurred.".format(ans[1], ans[2], ans[0])
+    logger.info(ans_str)
+    print(ans_str)
+    for name, title in (('osm', "Geocode cache"), ('tz', "Timezone cache")):
+        stats = [result['cache'][name] for result in results if name in result['cache']]
+        if stats:
+            cache_str = "{}: {} hits, {} misses.".format(title, sum(stat[0] for stat in stats),
+                                                         sum(stat[1] for stat in stats))
+            logger.info(cache_str)
+            print(cache_str)
     time_str = "Runtime of the program is {:.3f} hours.".format((time.time() - start_time) / 3600)
     logger.info(time_str)
     print(time_str)
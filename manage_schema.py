@@ -0,0 +1,310 @@
+import re
+import sys
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+
+import psycopg2
+
+import Pool as pools
+
+
+# Partitions of geo_summary by last_location_time. The script is run nightly: it creates the partitions of the next
+# periods in advance and detaches or drops the partitions older than the retention period, so the size of the
+# indexes scanned by the script and by the queries doesn't grow with the history.
+
+# Indexes of the partitioned table, they are created on every partition
+INDEXES = (
+    # Rows written by an interrupted run are not inserted twice
+    "CREATE UNIQUE INDEX IF NOT EXISTS {name}_device_time_idx ON {table} (device_id, last_location_time)",
+    "CREATE INDEX IF NOT EXISTS {name}_device_check_idx ON {table} (device_id, check_time DESC)",
+    "CREATE INDEX IF NOT EXISTS {name}_address_idx ON {table} (address_id)",
+    "CREATE INDEX IF NOT EXISTS {name}_location_idx ON {table} USING gist (Geography(last_location))",
+    # Rows are appended in the order of check_time, so a BRIN index is enough for the ranges of check_time
+    "CREATE INDEX IF NOT EXISTS {name}_check_time_idx ON {table} USING brin (check_time)"
+)
+
+TABLE = "CREATE TABLE IF NOT EXISTS {table} (" \
+        "uid bigserial, " \
+        "device_id bigint NOT NULL, " \
+        "last_location geometry(point, 4326) NOT NULL, " \
+        "address_id uuid NOT NULL, " \
+        "speed smallint NOT NULL CHECK(speed >= 0), " \
+        "last_location_time timestamp(6) NOT NULL, " \
+        "check_time timestamp(6) NOT NULL DEFAULT now(), " \
+        "timezone_shift numeric(4, 2) NOT NULL, " \
+        "PRIMARY KEY (uid, last_location_time)" \
+        ") PARTITION BY RANGE (last_location_time)"
+
+# Distinct addresses referenced by the rows, id = md5 of the jsonb text of the address
+ADDRESSES_TABLE = "CREATE TABLE IF NOT EXISTS {addresses_table} (id uuid PRIMARY KEY, address jsonb NOT NULL)"
+ADDRESSES_INDEX = "CREATE INDEX IF NOT EXISTS {name}_address_idx ON {addresses_table} " \
+                  "USING gin (address jsonb_path_ops)"
+
+# Rows with the address as jsonb, the same as the columns of the table before the addresses table
+VIEW = "CREATE OR REPLACE VIEW {table}_with_address AS " \
+       "SELECT t.uid, t.device_id, t.last_location, a.address, t.speed, t.last_location_time, t.check_time, " \
+       "t.timezone_shift FROM {table} t JOIN {addresses_table} a ON a.id = t.address_id"
+LATEST_VIEW = "CREATE OR REPLACE VIEW {latest_table}_with_address AS " \
+              "SELECT t.device_id, t.last_location, a.address, t.speed, t.last_location_time, t.check_time, " \
+              "t.timezone_shift FROM {latest_table} t JOIN {addresses_table} a ON a.id = t.address_id"
+
+INTERVALS = ("day", "month")
+
+
+# Start of the period which contains the moment
+def period_start(moment, interval):
+    if interval == "day":
+        return datetime(moment.year, moment.month, moment.day)
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_period(start, interval):
+    if interval == "day":
+        return start + timedelta(days=1)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def previous_period(start, interval):
+    if interval == "day":
+        return start - timedelta(days=1)
+    return datetime(start.year - (start.month == 1), (start.month - 2) % 12 + 1, 1)
+
+
+# Partitions are named by the start of their period: geo_summary_p20240101
+def partition_name(name, start):
+    return "{}_p{}".format(name, start.strftime("%Y%m%d"))
+
+
+# Bound of the partition as pg_get_expr returns it: '2024-01-01 00:00:00', MINVALUE or MAXVALUE
+def parse_bound(bound):
+    if bound in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(bound.strip("'"))
+
+
+class SchemaManager:
+    def __init__(self, connection, table, addresses_table, latest_table, logger, dry_run=False):
+        self._connection = connection
+        self._logger = logger
+        self._dry_run = dry_run
+        # The table name may be qualified with the schema
+        self._schema, self._name = table.split(".", 1) if "." in table else ("public", table)
+        self._table = "{}.{}".format(self._schema, self._name)
+        self._addresses_table = addresses_table
+        self._latest_table = latest_table
+
+    def execute(self, query, parameters=None):
+        self._logger.info(query)
+        if self._dry_run:
+            print(query + ";")
+            return
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+
+    def fetch_all(self, query, parameters=None):
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+            return cursor.fetchall()
+
+    # Create the partitioned table, its default partition, indexes, the addresses table and the views
+    def create_table(self):
+        self.check_index_names()
+        self.execute(ADDRESSES_TABLE.format(addresses_table=self._addresses_table))
+        self.execute(ADDRESSES_INDEX.format(name=self._addresses_table.split(".")[-1],
+                                            addresses_table=self._addresses_table))
+        self.execute(TABLE.format(table=self._table))
+        # Rows outside the created partitions are kept in the default partition
+        self.execute("CREATE TABLE IF NOT EXISTS {}.{}_default PARTITION OF {} DEFAULT".format(
+            self._schema, self._name, self._table))
+        for index in INDEXES:
+            self.execute(index.format(name=self._name, table=self._table))
+        self.execute(VIEW.format(table=self._table, addresses_table=self._addresses_table))
+        # The table of the last locations is created separately (see Geo_summary_table.md)
+        if self.fetch_all("SELECT to_regclass(%s)", (self._latest_table,))[0][0] is not None:
+            self.execute(LATEST_VIEW.format(latest_table=self._latest_table, addresses_table=self._addresses_table))
+        else:
+            self._logger.info("Table {} doesn't exist, its view is not created.".format(self._latest_table))
+
+    # Indexes are created with IF NOT EXISTS, so an index with the same name of another table (e.g. of the existing
+    # table renamed to be attached as a partition) would be skipped silently and the table would have no such index
+    def check_index_names(self):
+        names = [re.search(r"EXISTS (\S+)", index).group(1).format(name=self._name) for index in INDEXES]
+        rows = self.fetch_all("SELECT indexname, tablename FROM pg_indexes WHERE schemaname = %s "
+                              "AND indexname = ANY(%s) AND tablename <> %s", (self._schema, names, self._name))
+        if rows:
+            raise Exception("indexes of other tables have the names of the indexes of {}: {}, rename them".format(
+                self._table, ", ".join("{} ({})".format(*row) for row in rows)))
+
+    # Returns [(lower bound, upper bound, partition name)] of the attached partitions except the default one,
+    # the bound is None for MINVALUE and MAXVALUE
+    def partitions(self):
+        rows = self.fetch_all("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                              "JOIN pg_class c ON c.oid = i.inhrelid "
+                              "JOIN pg_class p ON p.oid = i.inhparent "
+                              "JOIN pg_namespace n ON n.oid = p.relnamespace "
+                              "WHERE n.nspname = %s AND p.relname = %s", (self._schema, self._name))
+        partitions = []
+        for relname, bound in rows:
+            match = re.fullmatch(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+            if match:
+                partitions.append((parse_bound(match.group(1)), parse_bound(match.group(2)), relname))
+        return partitions
+
+    # Create the partitions from the current period to premake periods ahead, the periods already covered by
+    # the attached partitions are skipped
+    # Returns the number of created partitions
+    def create_partitions(self, interval, premake, now):
+        existing = self.partitions()
+        start = period_start(now, interval)
+        created_cnt = 0
+        for i in range(premake + 1):
+            end = next_period(start, interval)
+            if not any(((lower is None) or (lower < end)) and ((upper is None) or (start < upper))
+                       for lower, upper, relname in existing):
+                self.create_partition(start, end)
+                created_cnt += 1
+            start = end
+        return created_cnt
+
+    # Rows of the period written to the default partition before the partition of the period has been created
+    # (e.g. main.py has run between --init and the first run of this script) are moved to the new partition in
+    # the same transaction, otherwise PostgreSQL refuses to create the partition
+    def create_partition(self, start, end):
+        create = "CREATE TABLE {}.{} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+            self._schema, partition_name(self._name, start), self._table, start.isoformat(sep=" "),
+            end.isoformat(sep=" "))
+        default = "{}.{}_default".format(self._schema, self._name)
+        condition = "last_location_time >= '{}' AND last_location_time < '{}'".format(start.isoformat(sep=" "),
+                                                                                      end.isoformat(sep=" "))
+        if (self.fetch_all("SELECT to_regclass(%s)", (default,))[0][0] is None) or \
+                not self.fetch_all("SELECT EXISTS (SELECT 1 FROM {} WHERE {})".format(default, condition))[0][0]:
+            self.execute(create)
+            return
+        moved = "{}_moved".format(self._name)
+        self.execute("BEGIN")
+        try:
+            self.execute("CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP".format(moved, self._table))
+            self.execute("WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) "
+                         "INSERT INTO {} SELECT * FROM moved".format(default, condition, moved))
+            self.execute(create)
+            self.execute("INSERT INTO {} SELECT * FROM {}".format(self._table, moved))
+            self.execute("COMMIT")
+        except Exception:
+            self.execute("ROLLBACK")
+            raise
+
+    # Detach the partitions which have ended more than retention periods ago, drop them if drop is set,
+    # the old rows of the default partition are removed as well (see remove_default_rows)
+    # Returns the number of removed partitions
+    def apply_retention(self, interval, retention, drop, now):
+        if retention <= 0:
+            return 0
+        oldest = period_start(now, interval)
+        for i in range(retention):
+            oldest = previous_period(oldest, interval)
+        removed_cnt = 0
+        for lower, upper, relname in self.partitions():
+            if (upper is None) or (upper > oldest):
+                continue
+            self.execute("ALTER TABLE {} DETACH PARTITION {}.{}".format(self._table, self._schema, relname))
+            if drop:
+                self.execute("DROP TABLE {}.{}".format(self._schema, relname))
+            removed_cnt += 1
+        self.remove_default_rows(oldest, drop)
+        return removed_cnt
+
+    # The default partition can't be detached by periods, so its rows older than oldest are deleted if drop is set,
+    # otherwise they are moved to the table <name>_default_retained like the rows of the detached partitions
+    def remove_default_rows(self, oldest, drop):
+        default = "{}.{}_default".format(self._schema, self._name)
+        condition = "last_location_time < '{}'".format(oldest.isoformat(sep=" "))
+        if (self.fetch_all("SELECT to_regclass(%s)", (default,))[0][0] is None) or \
+                not self.fetch_all("SELECT EXISTS (SELECT 1 FROM {} WHERE {})".format(default, condition))[0][0]:
+            return
+        if drop:
+            self.execute("DELETE FROM {} WHERE {}".format(default, condition))
+            return
+        retained = "{}_retained".format(default)
+        self.execute("BEGIN")
+        try:
+            self.execute("CREATE TABLE IF NOT EXISTS {} (LIKE {})".format(retained, self._table))
+            self.execute("WITH moved AS (DELETE FROM {} WHERE {} RETURNING *) "
+                         "INSERT INTO {} SELECT * FROM moved".format(default, condition, retained))
+            self.execute("COMMIT")
+        except Exception:
+            self.execute("ROLLBACK")
+            raise
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', default="config.yaml", type=str, help="path to configuration file", metavar="path")
+    parser.add_argument('--init', action='store_true',
+                        help="create the partitioned table geo_summary with its default partition, indexes, "
+                             "the addresses table and the views geo_summary_with_address and "
+                             "geo_summary_latest_with_address, "
+                             "the partitions are not created")
+    parser.add_argument('--dry-run', action='store_true', help="print the statements instead of executing them")
+    namespace = parser.parse_args(sys.argv[1:])
+
+    logging.basicConfig(filename='geo_summary_schema.log', filemode='w', format='[%(levelname)s]   %(message)s')
+    logger = logging.getLogger("geo_sum_schema")
+    logger.setLevel('INFO')
+
+    try:
+        config = pools.read_config(namespace.c)
+        psql_config = config["PostgreSQL"]
+        # The same defaults as ConnectionPostgresql.addresses_table and ConnectionPostgresql.latest_table
+        addresses_table = psql_config.get("addresses_table", psql_config["table"] + "_addresses")
+        latest_table = psql_config.get("latest_table", psql_config["table"] + "_latest")
+        settings = config.get("Partitions") or {}
+        interval = settings.get("interval", "month")
+        if interval not in INTERVALS:
+            raise Exception("'interval' must be one of: {}".format(", ".join(INTERVALS)))
+        premake = int(settings.get("premake", 3))
+        retention = int(settings.get("retention", 0))
+        drop = settings.get("retention_action", "detach") == "drop"
+    except Exception as e:
+        logger.critical("Failed to read configuration file. The error occurred: {}.".format(e))
+        print("Failed to read configuration file. The error occurred: {}".format(e))
+        sys.exit(-10)
+
+    try:
+        psql_connection = psycopg2.connect(host=psql_config["host"], port=psql_config["port"],
+                                           user=psql_config["user"], password=psql_config["password"],
+                                           database=psql_config["database"])
+        psql_connection.autocommit = True
+    except Exception as e:
+        logger.critical("Failed to connect to PostgreSQL. The error occurred: {}.".format(e))
+        print("Failed to connect to database. Details are in geo_summary_schema.log.")
+        sys.exit(-10)
+
+    manager = SchemaManager(psql_connection, psql_config["table"], addresses_table, latest_table, logger,
+                            namespace.dry_run)
+    try:
+        created_cnt = removed_cnt = 0
+        # The partitions are created by the next run, so the existing table can be attached before it
+        if namespace.init:
+            manager.create_table()
+        else:
+            now = datetime.utcnow()
+            created_cnt = manager.create_partitions(interval, premake, now)
+            removed_cnt = manager.apply_retention(interval, retention, drop, now)
+    except Exception as e:
+        logger.critical("Failed to update partitions. The error occurred: {}.".format(e))
+        print("Failed to update partitions. Details are in geo_summary_schema.log.")
+        sys.exit(-11)
+    finally:
+        psql_connection.close()
+
+    ans_str = "Created {} partitions. {} {} partitions.".format(created_cnt, "Dropped" if drop else "Detached",
+                                                                removed_cnt)
+    logger.info(ans_str)
+    print(ans_str)
+    time_str = "Runtime of the program is {:.3f} hours.".format((time.time() - start_time) / 3600)
+    logger.info(time_str)
+    print(time_str)